@@ -41,11 +41,27 @@ class Config(object):
         'PLEX_FIX_MISMATCHED_LANG': 'en',
         'PLEX_TOKEN': '',
         'PLEX_CHECK_BEFORE_SCAN': False,
+        'PLEX_PARTS_INDEX': False,
+        'PLEX_PARTS_INDEX_CAPACITY': 5000000,
         'SERVER_IP': '0.0.0.0',
         'SERVER_PORT': 3467,
         'SERVER_PASS': uuid.uuid4().hex,
         'SERVER_PATH_MAPPINGS': {},
         'SERVER_SCAN_DELAY': 180,
+        'SERVER_SCAN_WORKERS': 10,
+        'SERVER_POST_PROCESS_WORKERS': 2,
+        'SERVER_SCAN_SLOTS': 1,
+        'SERVER_SCAN_SECTION_SLOTS': {},
+        'SERVER_SCAN_BATCH_SIZE': 50,
+        'SERVER_SCAN_PRIORITY_AGING': 300,
+        'SERVER_SCAN_MAX_WAIT': 0,
+        'SERVER_SCAN_SOURCE_WEIGHTS': {
+            'Sonarr': 4,
+            'Radarr': 4,
+            'Lidarr': 4,
+            'Manual': 4,
+            'Google Drive': 1
+        },
         'SERVER_MAX_FILE_CHECKS': 10,
         'SERVER_FILE_CHECK_DELAY': 60,
         'SERVER_FILE_EXIST_PATH_MAPPINGS': {},
@@ -1,10 +1,16 @@
+import bisect
 import logging
 import os
+import threading
+import time
 
 from peewee import DeleteQuery
-from peewee import Model, SqliteDatabase, CharField, IntegerField
+from peewee import Model, SqliteDatabase, CharField, IntegerField, FloatField, fn
+from playhouse.migrate import SqliteMigrator, migrate
 
 import config
+import threads
+import utils
 
 logger = logging.getLogger("DB")
 
@@ -12,7 +18,14 @@ logger = logging.getLogger("DB")
 conf = config.Config()
 
 db_path = conf.settings['queuefile']
-database = SqliteDatabase(db_path, threadlocals=True)
+database = SqliteDatabase(db_path, threadlocals=True, pragmas=(('journal_mode', 'wal'), ('busy_timeout', 30000)))
+
+# pending -> waiting_file (file checks and scan backlog) -> scanning -> post_processing -> done / failed
+ACTIVE_STATES = ('pending', 'waiting_file', 'scanning', 'post_processing')
+# once plex has scanned a request, a new request for its folder has to be scanned again. post_processing rows are
+# only kept to resume them after a restart, so just these states make a new request a duplicate
+QUEUED_STATES = ('pending', 'waiting_file', 'scanning')
+FINISHED_STATES = ('done', 'failed')
 
 
 class BaseQueueModel(Model):
@@ -25,6 +38,19 @@ class QueueItemModel(BaseQueueModel):
     scan_for = CharField(max_length=64, null=False)
     scan_section = IntegerField(null=False)
     scan_type = CharField(max_length=64, null=False)
+    scan_dir = CharField(max_length=256, index=True, null=False, default='')
+    state = CharField(max_length=16, index=True, null=False, default='pending')
+    attempts = IntegerField(null=False, default=0)
+    queued_at = FloatField(null=True)
+    started_at = FloatField(null=True)
+    finished_at = FloatField(null=True)
+
+
+# in-memory mirror of the scan_dir column, {scan_dir: [scan_path]} and its keys in sorted order for prefix lookups
+scan_dirs = {}
+scan_dir_keys = []
+scan_path_dirs = {}
+scan_dirs_lock = threading.Lock()
 
 
 def create_database(db, db_path):
@@ -33,6 +59,32 @@ def create_database(db, db_path):
         logger.info("Created Plex Autoscan database tables.")
 
 
+def migrate_database(db):
+    table = QueueItemModel._meta.db_table
+    columns = [column.name for column in db.get_columns(table)]
+    migrator = SqliteMigrator(db)
+    if 'scan_dir' not in columns:
+        with db.atomic():
+            migrate(migrator.add_column(table, 'scan_dir', QueueItemModel.scan_dir),
+                    migrator.add_index(table, ('scan_dir',), False))
+            for item in QueueItemModel.select():
+                # the file exists path mappings are not at hand here, check the queued path itself
+                scan_dir = utils.get_scan_directory_key(item.scan_path, os.path.isdir(item.scan_path))
+                QueueItemModel.update(scan_dir=scan_dir) \
+                    .where(QueueItemModel.id == item.id).execute()
+        logger.info("Added 'scan_dir' column to Plex Autoscan database.")
+    if 'state' not in columns:
+        # rows from before states were tracked are treated as pending
+        with db.atomic():
+            migrate(migrator.add_column(table, 'state', QueueItemModel.state),
+                    migrator.add_column(table, 'attempts', QueueItemModel.attempts),
+                    migrator.add_column(table, 'queued_at', QueueItemModel.queued_at),
+                    migrator.add_column(table, 'started_at', QueueItemModel.started_at),
+                    migrator.add_column(table, 'finished_at', QueueItemModel.finished_at),
+                    migrator.add_index(table, ('state',), False))
+        logger.info("Added job state columns to Plex Autoscan database.")
+
+
 def connect(db):
     if not db.is_closed():
         return False
@@ -43,6 +95,9 @@ def init(db, db_path):
     if not os.path.exists(db_path):
         create_database(db, db_path)
     connect(db)
+    migrate_database(db)
+    load_scan_dirs()
+    intake.start()
 
 
 def get_next_item():
@@ -55,27 +110,66 @@ def get_next_item():
     return item
 
 
-def exists_file_root_path(file_path):
-    items = get_all_items()
-    if '.' in file_path:
-        dir_path = os.path.dirname(file_path)
-    else:
-        dir_path = file_path
-
-    for item in items:
-        if dir_path.lower() in item['scan_path'].lower():
-            return True, item['scan_path']
+def load_scan_dirs():
+    with scan_dirs_lock:
+        scan_dirs.clear()
+        scan_path_dirs.clear()
+        for item in QueueItemModel.select(QueueItemModel.scan_path, QueueItemModel.scan_dir) \
+                .where(QueueItemModel.state << QUEUED_STATES):
+            scan_dirs.setdefault(item.scan_dir, []).append(item.scan_path)
+            scan_path_dirs[item.scan_path] = item.scan_dir
+        scan_dir_keys[:] = sorted(scan_dirs)
+
+
+def add_scan_dir(scan_path, scan_dir):
+    with scan_dirs_lock:
+        if scan_dir not in scan_dirs:
+            scan_dirs[scan_dir] = []
+            bisect.insort(scan_dir_keys, scan_dir)
+        scan_dirs[scan_dir].append(scan_path)
+        scan_path_dirs[scan_path] = scan_dir
+
+
+def remove_scan_dir(scan_path):
+    with scan_dirs_lock:
+        scan_dir = scan_path_dirs.pop(scan_path, None)
+        scan_paths = scan_dirs.get(scan_dir)
+        if scan_paths is None or scan_path not in scan_paths:
+            return
+        scan_paths.remove(scan_path)
+        if not scan_paths:
+            del scan_dirs[scan_dir]
+            del scan_dir_keys[bisect.bisect_left(scan_dir_keys, scan_dir)]
+
+
+def get_scan_dir(scan_path):
+    with scan_dirs_lock:
+        return scan_path_dirs.get(scan_path)
+
+
+def exists_file_root_path(scan_dir):
+    # a queued item in the same folder, or in a folder below it, makes this request a duplicate
+    with scan_dirs_lock:
+        index = bisect.bisect_left(scan_dir_keys, scan_dir)
+        while index < len(scan_dir_keys) and scan_dir_keys[index].startswith(scan_dir):
+            key = scan_dir_keys[index]
+            if key == scan_dir or key.startswith(scan_dir.rstrip(os.sep) + os.sep):
+                return True, scan_dirs[key][0]
+            index += 1
     return False, None
 
 
 def get_all_items():
     items = []
     try:
-        for item in QueueItemModel.select():
+        for item in QueueItemModel.select().where(QueueItemModel.state << ACTIVE_STATES):
             items.append({'scan_path': item.scan_path,
                           'scan_for': item.scan_for,
                           'scan_type': item.scan_type,
-                          'scan_section': item.scan_section})
+                          'scan_section': item.scan_section,
+                          'scan_dir': item.scan_dir,
+                          'state': item.state,
+                          'attempts': item.attempts})
     except Exception:
         logger.exception("Exception getting all items from Plex Autoscan database: ")
         return None
@@ -85,36 +179,103 @@ def get_all_items():
 def get_queue_count():
     count = 0
     try:
-        count = QueueItemModel.select().count()
+        count = QueueItemModel.select().where(QueueItemModel.state << QUEUED_STATES).count()
     except Exception:
         logger.exception("Exception getting queued item count from Plex Autoscan database: ")
     return count
 
 
-def remove_item(scan_path):
+def get_state_stats():
+    # per state: number of items, age of the oldest one and, for finished items, the time from queued to finished
+    stats = {}
+    now = time.time()
+    try:
+        for row in QueueItemModel.select(QueueItemModel.state,
+                                         fn.COUNT(QueueItemModel.id).alias('count'),
+                                         fn.MIN(QueueItemModel.queued_at).alias('oldest'),
+                                         fn.AVG(QueueItemModel.finished_at - QueueItemModel.queued_at).alias('latency'),
+                                         fn.MAX(QueueItemModel.finished_at - QueueItemModel.queued_at).alias(
+                                             'max_latency'),
+                                         fn.MAX(QueueItemModel.attempts).alias('max_attempts')) \
+                .group_by(QueueItemModel.state).dicts():
+            stats[row['state']] = {'count': row['count'],
+                                   'oldest': int(now - row['oldest']) if row['oldest'] else None,
+                                   'max_attempts': row['max_attempts']}
+            if row['state'] in FINISHED_STATES:
+                stats[row['state']]['latency'] = round(row['latency'], 1) if row['latency'] is not None else None
+                stats[row['state']]['max_latency'] = round(row['max_latency'], 1) \
+                    if row['max_latency'] is not None else None
+    except Exception:
+        logger.exception("Exception getting job state stats from Plex Autoscan database: ")
+    return stats
+
+
+def set_item_state(scan_path, state, from_states=ACTIVE_STATES):
+    # only rows currently in one of from_states are moved to state
     try:
-        return DeleteQuery(QueueItemModel).where(QueueItemModel.scan_path == scan_path).execute()
+        now = time.time()
+        fields = {'state': state}
+        if state == 'scanning':
+            fields['started_at'] = now
+            fields['attempts'] = QueueItemModel.attempts + 1
+        elif state in FINISHED_STATES:
+            fields['finished_at'] = now
+        updated = QueueItemModel.update(**fields).where((QueueItemModel.scan_path == scan_path) &
+                                                       (QueueItemModel.state << from_states)).execute()
+        if updated and state not in QUEUED_STATES and any(x in QUEUED_STATES for x in from_states):
+            remove_scan_dir(scan_path)
+        return updated
     except Exception:
-        logger.exception("Exception deleting %r from Plex Autoscan database: ", scan_path)
+        logger.exception("Exception setting state of %r to %r in Plex Autoscan database: ", scan_path, state)
         return False
 
 
-def add_item(scan_path, scan_for, scan_section, scan_type):
-    item = None
+def purge_finished_items(retention=86400):
     try:
-        return QueueItemModel.create(scan_path=scan_path, scan_for=scan_for, scan_section=scan_section,
-                                     scan_type=scan_type)
-    except AttributeError as ex:
-        return item
+        return DeleteQuery(QueueItemModel).where((QueueItemModel.state << FINISHED_STATES) &
+                                                 (QueueItemModel.finished_at < time.time() - retention)).execute()
     except Exception:
-        pass
-        # logger.exception("Exception adding %r to database: ", scan_path)
-    return item
+        logger.exception("Exception purging finished items from Plex Autoscan database: ")
+        return 0
+
+
+def commit_items(items):
+    # one transaction for the whole batch, each insert gets its own savepoint so a duplicate only fails itself
+    created = []
+    with database.atomic():
+        for fields in items:
+            try:
+                with database.atomic():
+                    # a finished row for the same path is only kept for stats, and one in post-processing only for
+                    # resuming it after a restart, which the new request covers as well. make room for the new request
+                    replaceable = FINISHED_STATES + ('post_processing',)
+                    DeleteQuery(QueueItemModel).where((QueueItemModel.scan_path == fields['scan_path']) &
+                                                      (QueueItemModel.state << replaceable)).execute()
+                    created.append(QueueItemModel.create(**fields))
+            except Exception:
+                # logger.exception("Exception adding %r to database: ", fields['scan_path'])
+                created.append(None)
+
+    for item in created:
+        if item is not None:
+            add_scan_dir(item.scan_path, item.scan_dir)
+    return created
+
+
+# requests arriving while an earlier commit is still being written are written together with a single commit
+intake = threads.GroupCommitter(commit_items, name='db_intake')
+
+
+def add_item(scan_path, scan_for, scan_section, scan_type, scan_dir):
+    # returns once the batch this request was written with is committed
+    return intake.submit({'scan_path': scan_path, 'scan_for': scan_for, 'scan_section': scan_section,
+                          'scan_type': scan_type, 'scan_dir': scan_dir,
+                          'state': 'pending', 'queued_at': time.time()})
 
 
 def queued_count():
     try:
-        return QueueItemModel.select().count()
+        return QueueItemModel.select().where(QueueItemModel.state << QUEUED_STATES).count()
     except Exception:
         logger.exception("Exception retrieving queued count: ")
     return 0
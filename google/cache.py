@@ -1,15 +1,177 @@
 import json
+import logging
+import sqlite3
+import threading
+from collections import OrderedDict
 
-from sqlitedict import SqliteDict
+logger = logging.getLogger("CACHE")
+
+# one connection per cache file, shared by every Cache opened on it
+connections = {}
+connections_lock = threading.Lock()
+
+MISSING = object()
 
 
 class Cache:
-    def __init__(self, cache_file_path):
+    def __init__(self, cache_file_path, memory_items=100000):
         self.cache_file_path = cache_file_path
+        self.memory_items = memory_items
         self.caches = {}
+        with connections_lock:
+            if cache_file_path not in connections:
+                connections[cache_file_path] = self._open(cache_file_path)
+            self.conn, self.lock = connections[cache_file_path]
 
     def get_cache(self, cache_name, autocommit=False):
         if cache_name not in self.caches:
-            self.caches[cache_name] = SqliteDict(self.cache_file_path, tablename=cache_name, encode=json.dumps,
-                                                 decode=json.loads, autocommit=autocommit)
+            self.caches[cache_name] = CacheStore(self, cache_name, autocommit=autocommit)
         return self.caches[cache_name]
+
+    @staticmethod
+    def _open(cache_file_path):
+        conn = sqlite3.connect(cache_file_path, timeout=30, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS items (cache TEXT NOT NULL, id TEXT NOT NULL, name TEXT, md5 TEXT, "
+                     "PRIMARY KEY (cache, id))")
+        conn.execute("CREATE TABLE IF NOT EXISTS item_parents (cache TEXT NOT NULL, id TEXT NOT NULL, "
+                     "parent_id TEXT NOT NULL, PRIMARY KEY (cache, id, parent_id))")
+        conn.execute("CREATE INDEX IF NOT EXISTS item_parents_parent ON item_parents (cache, parent_id)")
+        conn.execute("CREATE TABLE IF NOT EXISTS kv (cache TEXT NOT NULL, key TEXT NOT NULL, value TEXT, "
+                     "PRIMARY KEY (cache, key))")
+        conn.commit()
+        lock = threading.RLock()
+        Cache._migrate_sqlitedict_tables(conn)
+        return conn, lock
+
+    @staticmethod
+    def _migrate_sqlitedict_tables(conn):
+        # older versions kept each cache as a sqlitedict table of (key, json value) rows
+        tables = []
+        for (table,) in conn.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall():
+            columns = [row[1] for row in conn.execute('PRAGMA table_info("%s")' % table.replace('"', '""'))]
+            if columns == ['key', 'value']:
+                tables.append(table)
+        if not tables:
+            return
+
+        for table in tables:
+            logger.info("Migrating cache '%s' to the new cache format...", table)
+            migrated = 0
+            cursor = conn.execute('SELECT key, value FROM "%s"' % table.replace('"', '""'))
+            while True:
+                rows = cursor.fetchmany(10000)
+                if not rows:
+                    break
+                for key, value in rows:
+                    if isinstance(value, bytes):
+                        value = value.decode('utf-8')
+                    CacheStore.write(conn, table, key, json.loads(value))
+                    migrated += 1
+            conn.execute('DROP TABLE "%s"' % table.replace('"', '""'))
+            conn.commit()
+            logger.info("Migrated %d entries of cache '%s'.", migrated, table)
+
+        # give the space used by the old tables back
+        conn.execute("VACUUM")
+
+
+class CacheStore:
+    def __init__(self, cache, name, autocommit=False):
+        self.name = name
+        self.autocommit = autocommit
+        self.memory_items = cache.memory_items
+        self.conn = cache.conn
+        self.lock = cache.lock
+        # read-through layer over the items table, MISSING marks an id known not to be cached
+        self._items = OrderedDict()
+        with self.lock:
+            self._kv = dict((key, json.loads(value)) for key, value in
+                            self.conn.execute("SELECT key, value FROM kv WHERE cache=?", (name,)))
+
+    @staticmethod
+    def is_item(value):
+        return isinstance(value, dict) and 'name' in value and 'parents' in value
+
+    @staticmethod
+    def write(conn, name, key, value):
+        if CacheStore.is_item(value):
+            conn.execute("INSERT OR REPLACE INTO items (cache, id, name, md5) VALUES (?, ?, ?, ?)",
+                         (name, key, value['name'], value.get('md5Checksum')))
+            conn.execute("DELETE FROM item_parents WHERE cache=? AND id=?", (name, key))
+            conn.executemany("INSERT OR IGNORE INTO item_parents (cache, id, parent_id) VALUES (?, ?, ?)",
+                             [(name, key, parent) for parent in value['parents'] or []])
+        else:
+            conn.execute("INSERT OR REPLACE INTO kv (cache, key, value) VALUES (?, ?, ?)",
+                         (name, key, json.dumps(value)))
+
+    def _remember(self, key, value):
+        self._items.pop(key, None)
+        self._items[key] = value
+        if len(self._items) > self.memory_items:
+            self._items.popitem(last=False)
+
+    def _load(self, key):
+        row = self.conn.execute("SELECT name, md5 FROM items WHERE cache=? AND id=?",
+                                (self.name, key)).fetchone()
+        if row is None:
+            return MISSING
+        parents = [parent for (parent,) in self.conn.execute(
+            "SELECT parent_id FROM item_parents WHERE cache=? AND id=? ORDER BY rowid", (self.name, key))]
+        return {'name': row[0], 'parents': parents, 'md5Checksum': row[1]}
+
+    def child_folders(self, parent_id):
+        # children of parent_id that are parents themselves, found through the parent index of item_parents
+        with self.lock:
+            return [child for (child,) in self.conn.execute(
+                "SELECT DISTINCT p.id FROM item_parents p WHERE p.cache=? AND p.parent_id=? AND EXISTS "
+                "(SELECT 1 FROM item_parents c WHERE c.cache=p.cache AND c.parent_id=p.id)", (self.name, parent_id))]
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key in self._kv:
+                return self._kv[key]
+            value = self._items.get(key)
+            if value is None:
+                value = self._load(key)
+            self._remember(key, value)
+        return default if value is MISSING else value
+
+    def __contains__(self, key):
+        return self.get(key, MISSING) is not MISSING
+
+    def __getitem__(self, key):
+        value = self.get(key, MISSING)
+        if value is MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.write(self.conn, self.name, key, value)
+            if self.is_item(value):
+                self._remember(key, value)
+            else:
+                self._kv[key] = value
+            if self.autocommit:
+                self.conn.commit()
+
+    def pop(self, key, default=None):
+        with self.lock:
+            value = self.get(key, MISSING)
+            if value is MISSING:
+                return default
+            if key in self._kv:
+                del self._kv[key]
+                self.conn.execute("DELETE FROM kv WHERE cache=? AND key=?", (self.name, key))
+            else:
+                self._remember(key, MISSING)
+                self.conn.execute("DELETE FROM items WHERE cache=? AND id=?", (self.name, key))
+                self.conn.execute("DELETE FROM item_parents WHERE cache=? AND id=?", (self.name, key))
+            if self.autocommit:
+                self.conn.commit()
+        return value
+
+    def commit(self, blocking=True):
+        with self.lock:
+            self.conn.commit()
@@ -1,18 +1,67 @@
+try:
+    # Try the Python 3 queue module
+    import queue
+except ImportError:
+    # Fallback to the Python 2 Queue module
+    import Queue as queue
 import logging
 import os
+import threading
 import time
 from collections import OrderedDict
 from copy import copy
-from threading import Lock
+from multiprocessing.pool import ThreadPool
 from time import time
 
 from requests_oauthlib import OAuth2Session
 
+import utils
 from .cache import Cache
 
 logger = logging.getLogger("GOOGLE")
 
 
+def prefetch(iterable, depth=1, name=None):
+    # runs iterable on its own thread, keeping up to depth items ready while the caller works on the current one
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    finished = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except Exception as ex:
+            put((finished, ex))
+            return
+        put((finished, None))
+
+    producer = threading.Thread(target=produce, name=name)
+    producer.daemon = True
+    producer.start()
+    try:
+        while True:
+            item, ex = items.get()
+            if item is finished:
+                if ex is not None:
+                    raise ex
+                return
+            yield item
+    finally:
+        # tell the producer to stop if the caller gave up early
+        stop.set()
+
+
 class GoogleDriveManager:
     def __init__(self, client_id, client_secret, cache_path, allowed_config=None, show_cache_logs=True,
                  crypt_decoder=None, allowed_teamdrives=None):
@@ -96,7 +145,7 @@ class GoogleDrive:
 
     def __init__(self, client_id, client_secret, cache_path, allowed_config={}, show_cache_logs=True,
                  crypt_decoder=None,
-                 teamdrive_id=None):
+                 teamdrive_id=None, folder_paths_size=20000):
         self.client_id = client_id
         self.client_secret = client_secret
         self.cache_path = cache_path
@@ -105,13 +154,18 @@ class GoogleDrive:
         self.settings_cache = self.cache_manager.get_cache('settings', autocommit=True)
         self.support_team_drives = True if teamdrive_id is not None else False
         self.token = self._load_token()
-        self.token_refresh_lock = Lock()
-        self.http = self._new_http_object()
+        # the prefetch threads query at the same time, each thread gets its own session and one of them renews the
+        # shared token at a time
+        self.token_refresh_lock = threading.RLock()
+        self._local = threading.local()
+        self._prefetch_pool = None
         self.callbacks = {}
         self.allowed_config = allowed_config
         self.show_cache_logs = show_cache_logs
         self.crypt_decoder = crypt_decoder
         self.teamdrive_id = teamdrive_id
+        # resolved paths of recently used folders, the cache finds their subfolders again to invalidate them
+        self.folder_paths = utils.LRUCache(folder_paths_size)
 
     ############################################################
     # CORE CLASS METHODS
@@ -127,11 +181,11 @@ class GoogleDrive:
         return
 
     def get_auth_link(self):
-        auth_url, state = self.http.authorization_url(self.auth_url, access_type='offline', prompt='select_account')
+        auth_url, state = self._get_http().authorization_url(self.auth_url, access_type='offline', prompt='select_account')
         return auth_url
 
     def exchange_code(self, code):
-        token = self.http.fetch_token(self.token_url, code=code, client_secret=self.client_secret)
+        token = self._get_http().fetch_token(self.token_url, code=code, client_secret=self.client_secret)
         if 'access_token' in token:
             self._token_saver(token)
             # pull in existing team drives and create cache for them
@@ -139,63 +193,44 @@ class GoogleDrive:
 
     def query(self, path, method='GET', page_type='changes', fetch_all_pages=False, callbacks={}, **kwargs):
         resp = None
-        pages = 1
         resp_json = {}
         request_url = self.api_url + path.lstrip('/') if not path.startswith('http') else path
+        # pages handed to a data_callback are not accumulated, so only one page is held at a time
+        stream_pages = page_type == 'changes' and fetch_all_pages and 'data_callback' in callbacks
 
         try:
-            while True:
-                resp = self._do_query(request_url, method, **kwargs)
-                logger.debug("Request URL: %s", resp.url)
-                logger.debug("Request ARG: %s", kwargs)
-                logger.debug('Response Status: %d %s', resp.status_code, resp.reason)
-                logger.debug('Response Content:\n%s\n', resp.text)
+            pages = self.iter_pages(request_url, method, fetch_all_pages, **kwargs)
+            if stream_pages:
+                # the next page is downloaded while data_callback works on the current one
+                pages = prefetch(pages, name='page_prefetch')
 
-                if 'Content-Type' in resp.headers and 'json' in resp.headers['Content-Type']:
-                    if fetch_all_pages:
-                        resp_json.pop('nextPageToken', None)
-                    new_json = resp.json()
-                    # does this page have changes
-                    extended_pages = False
-                    page_data = []
-                    if page_type in new_json:
-                        if page_type in resp_json:
-                            page_data.extend(resp_json[page_type])
-                        page_data.extend(new_json[page_type])
-                        extended_pages = True
+            for resp, new_json in pages:
+                if new_json is None:
+                    return False if resp.status_code != 200 else True, resp, resp.text
 
+                if fetch_all_pages:
+                    resp_json.pop('nextPageToken', None)
+                # does this page have changes
+                if page_type in new_json and not stream_pages:
+                    page_data = resp_json.get(page_type, [])
+                    page_data.extend(new_json[page_type])
                     resp_json.update(new_json)
-                    if extended_pages:
-                        resp_json[page_type] = page_data
+                    resp_json[page_type] = page_data
                 else:
-                    return False if resp.status_code != 200 else True, resp, resp.text
+                    resp_json.update((key, value) for key, value in new_json.items() if key != page_type)
+
+                # call data_callback, fetch_all_pages is true
+                if stream_pages:
+                    callbacks['data_callback'](new_json)
 
                 # call page_token_callback to update cached page_token, if specified
+                # only once the page has been processed, so a restart resumes from the first unprocessed page
                 if page_type == 'changes' and 'page_token_callback' in callbacks:
                     if 'nextPageToken' in resp_json:
                         callbacks['page_token_callback'](resp_json['nextPageToken'])
                     elif 'newStartPageToken' in resp_json:
                         callbacks['page_token_callback'](resp_json['newStartPageToken'])
 
-                # call data_callback, fetch_all_pages is true
-                if page_type == 'changes' and fetch_all_pages and 'data_callback' in callbacks:
-                    callbacks['data_callback'](resp.json())
-
-                # handle nextPageToken
-                if fetch_all_pages and 'nextPageToken' in resp_json and resp_json['nextPageToken']:
-                    # there are more pages
-                    pages += 1
-                    logger.info("Fetching extra results from page %d", pages)
-                    if 'params' in kwargs:
-                        kwargs['params'].update({'pageToken': resp_json['nextPageToken']})
-                    elif 'json' in kwargs:
-                        kwargs['json'].update({'pageToken': resp_json['nextPageToken']})
-                    elif 'data' in kwargs:
-                        kwargs['data'].update({'pageToken': resp_json['nextPageToken']})
-                    continue
-
-                break
-
             return True if resp_json and len(resp_json) else False, resp, resp_json if (
                     resp_json and len(resp_json)) else resp.text
 
@@ -203,6 +238,38 @@ class GoogleDrive:
             logger.exception("Exception sending request to %s with kwargs=%s: ", request_url, kwargs)
             return False, resp, None
 
+    def iter_pages(self, request_url, method='GET', fetch_all_pages=True, **kwargs):
+        # yields (resp, json) for each page as it is fetched, json is None for non json responses
+        pages = 1
+        while True:
+            resp = self._do_query(request_url, method, **kwargs)
+            logger.debug("Request URL: %s", resp.url)
+            logger.debug("Request ARG: %s", kwargs)
+            logger.debug('Response Status: %d %s', resp.status_code, resp.reason)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug('Response Content:\n%s\n', resp.text)
+
+            if 'Content-Type' not in resp.headers or 'json' not in resp.headers['Content-Type']:
+                yield resp, None
+                return
+
+            page_json = resp.json()
+            yield resp, page_json
+
+            # handle nextPageToken
+            if not fetch_all_pages or not page_json.get('nextPageToken'):
+                return
+
+            # there are more pages
+            pages += 1
+            logger.info("Fetching extra results from page %d", pages)
+            if 'params' in kwargs:
+                kwargs['params'].update({'pageToken': page_json['nextPageToken']})
+            elif 'json' in kwargs:
+                kwargs['json'].update({'pageToken': page_json['nextPageToken']})
+            elif 'data' in kwargs:
+                kwargs['data'].update({'pageToken': page_json['nextPageToken']})
+
     ############################################################
     # DRIVE FUNCTIONS
     ############################################################
@@ -318,40 +385,52 @@ class GoogleDrive:
             return False, data
 
     def get_id_file_paths(self, item_id, teamdrive_id=None):
-        file_paths = []
-        added_to_cache = 0
+        new_cache_entries = [0]
 
         try:
-            def get_item_paths(obj_id, path, paths, new_cache_entries, teamdrive_id=None):
+            def get_item(obj_id, teamdrive_id=None):
                 success, obj = self.get_id_metadata(obj_id, teamdrive_id)
                 if not success:
-                    return new_cache_entries
-
-                teamdrive_id = teamdrive_id if 'teamDriveId' not in obj else obj['teamDriveId']
+                    return None
 
                 # add item object to cache if we know its not from cache
                 if 'mimeType' in obj:
                     # we know this is a new item fetched from the api, because the cache does not store this field
-                    self.add_item_to_cache(obj['id'], obj['name'], [] if 'parents' not in obj else obj['parents'],
+                    self.add_item_to_cache(obj_id, obj['name'], [] if 'parents' not in obj else obj['parents'],
                                            obj['md5Checksum'] if 'md5Checksum' in obj else None)
-                    new_cache_entries += 1
+                    new_cache_entries[0] += 1
+                return obj
+
+            def get_item_paths(obj_id, teamdrive_id=None, memoize=False):
+                # paths of a folder are remembered, so siblings only pay for a lookup and a join
+                if memoize:
+                    paths = self.folder_paths.get(obj_id)
+                    if paths is not None:
+                        return paths
+
+                obj = get_item(obj_id, teamdrive_id)
+                if obj is None:
+                    return []
+                teamdrive_id = teamdrive_id if 'teamDriveId' not in obj else obj['teamDriveId']
 
-                if path.strip() == '':
-                    path = obj['name']
+                if 'parents' not in obj or not obj['parents']:
+                    paths = [obj['name']] if len(obj['name']) else []
                 else:
-                    path = os.path.join(obj['name'], path)
-
-                if 'parents' in obj and obj['parents']:
+                    paths = []
+                    resolved = True
                     for parent in obj['parents']:
-                        new_cache_entries += get_item_paths(parent, path, paths, new_cache_entries, teamdrive_id)
-
-                if (not obj or 'parents' not in obj or not obj['parents']) and len(path):
-                    paths.append(path)
-                    return new_cache_entries
-                return new_cache_entries
-
-            added_to_cache += get_item_paths(item_id, '', file_paths, added_to_cache, teamdrive_id)
-            if added_to_cache:
+                        parent_paths = get_item_paths(parent, teamdrive_id, memoize=True)
+                        resolved = resolved and bool(parent_paths)
+                        paths.extend(os.path.join(parent_path, obj['name']) for parent_path in parent_paths)
+                    # do not remember a folder when one of its parents could not be looked up
+                    memoize = memoize and resolved
+
+                if memoize:
+                    self.folder_paths.put(obj_id, paths)
+                return paths
+
+            file_paths = get_item_paths(item_id, teamdrive_id)
+            if new_cache_entries[0]:
                 logger.debug("Dumping cache due to new entries!")
                 self._dump_cache()
 
@@ -365,16 +444,60 @@ class GoogleDrive:
 
         return False, []
 
-    def add_item_to_cache(self, item_id, item_name, item_parents, md5_checksum, file_paths=[]):
+    def invalidate_folder_paths(self, folder_id):
+        # forget the remembered paths of folder_id and everything below it
+        folder_ids = [folder_id]
+        seen = set()
+        while folder_ids:
+            folder_id = folder_ids.pop()
+            if folder_id in seen:
+                continue
+            seen.add(folder_id)
+            self.folder_paths.pop(folder_id)
+            folder_ids.extend(self.cache.child_folders(folder_id))
+
+    def prefetch_parents(self, changes, workers=8):
+        # fetch every ancestor folder of this page that is not cached yet, one level of the tree at a time with
+        # the requests of a level running concurrently, so resolving the paths afterwards runs from the cache
+        page_ids = set(change['fileId'] for change in changes if 'fileId' in change)
+        pending = set()
+        for change in changes:
+            if 'file' not in change or change.get('removed') or change['file'].get('trashed'):
+                continue
+            for parent in change['file'].get('parents', []):
+                pending.add((parent, change['file'].get('teamDriveId')))
+
+        fetched = 0
+        levels = 0
+        while pending:
+            # teamdrive roots are left to get_id_metadata, they are fetched from a different endpoint
+            missing = [(item_id, teamdrive_id) for item_id, teamdrive_id in pending
+                       if item_id != teamdrive_id and item_id not in page_ids and item_id not in self.cache]
+            if not missing:
+                break
+            if self._prefetch_pool is None:
+                self._prefetch_pool = ThreadPool(workers)
+            levels += 1
+
+            pending = set()
+            results = self._prefetch_pool.map(lambda item: self.get_id_metadata(item[0], item[1]), missing)
+            for (item_id, teamdrive_id), (success, obj) in zip(missing, results):
+                if not success or not isinstance(obj, dict) or 'name' not in obj:
+                    continue
+                self.add_item_to_cache(item_id, obj['name'], obj.get('parents', []), obj.get('md5Checksum'))
+                fetched += 1
+                for parent in obj.get('parents', []):
+                    pending.add((parent, obj.get('teamDriveId', teamdrive_id)))
+
+        if fetched:
+            logger.debug("Prefetched %d parent folder(s) over %d level(s)", fetched, levels)
+        return fetched
+
+    def add_item_to_cache(self, item_id, item_name, item_parents, md5_checksum):
         if self.show_cache_logs and item_id not in self.cache:
             logger.info("Added '%s' to cache: %s", item_id, item_name)
 
-        if not file_paths:
-            existing_item = self.cache[item_id] if item_id in self.cache else None
-            if existing_item is not None and 'paths' in existing_item:
-                file_paths = existing_item['paths']
-        self.cache[item_id] = {'name': item_name, 'parents': item_parents, 'md5Checksum': md5_checksum,
-                               'paths': file_paths}
+        self.cache[item_id] = {'name': item_name, 'parents': item_parents, 'md5Checksum': md5_checksum}
         return
 
     def remove_item_from_cache(self, item_id):
@@ -405,7 +528,6 @@ class GoogleDrive:
     def _do_query(self, request_url, method, **kwargs):
         tries = 0
         max_tries = 2
-        lock_acquirer = False
         resp = None
         use_timeout = 30
 
@@ -420,28 +542,22 @@ class GoogleDrive:
 
         # do query
         while tries < max_tries:
-            if self.token_refresh_lock.locked() and not lock_acquirer:
-                logger.debug("Token refresh lock is currently acquired. Trying again in 500ms...")
-                time.sleep(0.5)
-                continue
-
+            http = self._get_http()
+            access_token = http.token.get('access_token')
             if method == 'POST':
-                resp = self.http.post(request_url, timeout=use_timeout, **kwargs)
+                resp = http.post(request_url, timeout=use_timeout, **kwargs)
             elif method == 'PATCH':
-                resp = self.http.patch(request_url, timeout=use_timeout, **kwargs)
+                resp = http.patch(request_url, timeout=use_timeout, **kwargs)
             elif method == 'DELETE':
-                resp = self.http.delete(request_url, timeout=use_timeout, **kwargs)
+                resp = http.delete(request_url, timeout=use_timeout, **kwargs)
             else:
-                resp = self.http.get(request_url, timeout=use_timeout, **kwargs)
+                resp = http.get(request_url, timeout=use_timeout, **kwargs)
             tries += 1
 
             if resp.status_code == 401 and tries < max_tries:
                 # unauthorized error, lets refresh token and retry
-                self.token_refresh_lock.acquire(False)
-                lock_acquirer = True
                 logger.warning("Unauthorized Response (Attempts %d/%d)", tries, max_tries)
-                self.token['expires_at'] = time() - 10
-                self.http = self._new_http_object()
+                self._refresh_token(access_token)
             else:
                 break
 
@@ -465,17 +581,32 @@ class GoogleDrive:
         return False
 
     def _token_saver(self, token):
-        # update internal token dict
-        self.token.update(token)
-        try:
-            if self.token_refresh_lock.locked():
-                self.token_refresh_lock.release()
-        except Exception:
-            logger.exception("Exception releasing token_refresh_lock: ")
-        self._dump_token()
+        # update internal token dict, sessions of the other threads pick it up on their next request
+        with self.token_refresh_lock:
+            self.token.update(token)
+            self._dump_token()
         logger.info("Renewed access token!")
         return
 
+    def _refresh_token(self, failed_access_token):
+        with self.token_refresh_lock:
+            if self.token.get('access_token') != failed_access_token:
+                # another thread renewed it while this one waited for the lock
+                return
+            try:
+                self._token_saver(self._get_http().refresh_token(self.token_url, client_id=self.client_id,
+                                                                 client_secret=self.client_secret))
+            except Exception:
+                logger.exception("Exception renewing access token: ")
+
+    def _get_http(self):
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            http = self._local.http = self._new_http_object()
+        elif http.token.get('access_token') != self.token.get('access_token'):
+            http.token = dict(self.token)
+        return http
+
     def _page_token_saver(self, page_token):
         # update internal token dict
         self.cache['page_token'] = page_token
@@ -487,7 +618,7 @@ class GoogleDrive:
         return OAuth2Session(client_id=self.client_id, redirect_uri=self.redirect_url, scope=self.scopes,
                              auto_refresh_url=self.token_url, auto_refresh_kwargs={'client_id': self.client_id,
                                                                                    'client_secret': self.client_secret},
-                             token_updater=self._token_saver, token=self.token)
+                             token_updater=self._token_saver, token=dict(self.token))
 
     def _get_cached_metdata(self, item_id):
         if item_id in self.cache:
@@ -567,6 +698,9 @@ class GoogleDrive:
             return
         logger.info("Processing %d changes", len(data['changes']))
 
+        # look up unknown parent folders for the whole page up front
+        self.prefetch_parents(data['changes'])
+
         # process changes
         for change in data['changes']:
             if 'file' in change and 'fileId' in change:
@@ -575,12 +709,18 @@ class GoogleDrive:
                         'removed' in change and change['removed']):
                     if self.remove_item_from_cache(change['fileId']) and self.show_cache_logs:
                         logger.info("Removed '%s' from cache: %s", change['fileId'], change['file']['name'])
+                    self.invalidate_folder_paths(change['fileId'])
                     removes += 1
                     continue
 
                 # retrieve item from cache
                 existing_cache_item = self.get_item_from_cache(change['fileId'])
 
+                # a renamed or moved folder changes the paths of everything below it
+                if existing_cache_item is None or existing_cache_item.get('name') != change['file']['name'] or \
+                        existing_cache_item.get('parents') != change['file'].get('parents', []):
+                    self.invalidate_folder_paths(change['fileId'])
+
                 # we always want to add changes to the cache so renames etc can be reflected inside the cache
                 self.add_item_to_cache(change['fileId'], change['file']['name'],
                                        [] if 'parents' not in change['file'] else change['file']['parents'],
@@ -590,12 +730,6 @@ class GoogleDrive:
                 success, item_paths = self.get_id_file_paths(change['fileId'],
                                                              change['file']['teamDriveId'] if 'teamDriveId' in change[
                                                                  'file'] else None)
-                if success:
-                    # save item paths
-                    self.add_item_to_cache(change['fileId'], change['file']['name'],
-                                           [] if 'parents' not in change['file'] else change['file']['parents'],
-                                           change['file']['md5Checksum'] if 'md5Checksum' in change['file'] else None,
-                                           item_paths)
 
                 # check if decoder is present
                 if self.crypt_decoder:
@@ -646,9 +780,8 @@ class GoogleDrive:
                                     renamed_file_paths[change['fileId']].extend(item_paths)
                                 else:
                                     renamed_file_paths[change['fileId']] = item_paths
-                            elif 'paths' in existing_cache_item and not self._list_matches(item_paths,
-                                                                                           existing_cache_item[
-                                                                                               'paths']):
+                            elif sorted(existing_cache_item['parents'] or []) != \
+                                    sorted(change['file'].get('parents', [])):
                                 logger.debug("md5Checksum matches but file was server-side moved: %s", item_paths)
 
                                 if change['fileId'] in added_file_paths:
@@ -683,6 +816,7 @@ class GoogleDrive:
                 # dont consider trashed/removed events for processing
                 if 'removed' in change and change['removed']:
                     # remove item from cache
+                    self.invalidate_folder_paths(change['teamDriveId'])
                     if self.remove_item_from_cache(change['teamDriveId']):
                         if self.show_cache_logs and 'teamDrive' in change and 'name' in change['teamDrive']:
                             teamdrive_name = 'Unknown teamDrive'
@@ -701,6 +835,7 @@ class GoogleDrive:
                         self._do_callback('teamdrive_added', change)
 
                     self.add_item_to_cache(change['teamDrive']['id'], change['teamDrive']['name'], [], None)
+                    self.invalidate_folder_paths(change['teamDrive']['id'])
                     continue
 
         # always dump the cache after running changes
@@ -728,14 +863,3 @@ class GoogleDrive:
         if callback_type in self.callbacks and callback_data:
             self.callbacks[callback_type](callback_data)
         return
-
-    @staticmethod
-    def _list_matches(list_master, list_check):
-        try:
-            for item in list_master:
-                if item not in list_check:
-                    return False
-            return True
-        except Exception:
-            logger.exception('Exception checking if lists match: ')
-        return False
@@ -1,10 +1,10 @@
 import logging
 import os
-import sqlite3
 import time
 from contextlib import closing
 
 import db
+import plexdb
 
 try:
     from shlex import quote as cmd_quote
@@ -40,75 +40,73 @@ def show_detailed_sections_info(conf):
         logger.exception("Issue encountered when attempting to list detailed sections info.")
 
 
-def scan(config, lock, path, scan_for, section, scan_type, resleep_paths, scan_title=None, scan_lookup_type=None,
-         scan_lookup_id=None):
-    scan_path = ""
+def scan(config, job):
+    # performs one file check, returns the delay before the next check, 0 once the request is ready for the scan
+    # backlog or None when it was aborted
+    path = job['path']
+    if 'checks' not in job:
+        logger.info("Scan request from %s for '%s'.", job['scan_for'], path)
+        job['checks'] = 0
+        job['check_path'] = utils.map_pushed_path_file_exists(config, path)
+        job['scan_path'] = ""
+        job['scan_path_is_directory'] = os.path.isdir(job['check_path'])
+        if config['SERVER_USE_SQLITE']:
+            db.set_item_state(path, 'waiting_file')
+    elif config['RCLONE']['RC_CACHE_REFRESH']['ENABLED']:
+        # send Rclone cache clear if enabled
+        utils.rclone_rc_clear_cache(config, job['check_path'])
 
-    # sleep for delay
-    while True:
-        logger.info("Scan request from %s for '%s'.", scan_for, path)
+    # check file exists
+    job['checks'] += 1
+    checks = job['checks']
+    check_path = job['check_path']
+    if os.path.exists(check_path):
+        logger.info("File '%s' exists on check %d of %d.", check_path, checks, config['SERVER_MAX_FILE_CHECKS'])
+        if not job['scan_path'] or not len(job['scan_path']):
+            job['scan_path'] = os.path.dirname(path).strip() if not job['scan_path_is_directory'] else path.strip()
+
+    elif not job['scan_path_is_directory'] and config['SERVER_SCAN_FOLDER_ON_FILE_EXISTS_EXHAUSTION'] and \
+            config['SERVER_MAX_FILE_CHECKS'] - checks == 1:
+        # penultimate check but SERVER_SCAN_FOLDER_ON_FILE_EXISTS_EXHAUSTION was turned on
+        # lets make scan path the folder instead for the final check
+        logger.warning(
+            "File '%s' reached the penultimate file check. Changing scan path to '%s'. Final check commences "
+            "in %s seconds...", check_path, os.path.dirname(path), config['SERVER_FILE_CHECK_DELAY'])
+        job['check_path'] = os.path.dirname(check_path).strip()
+        job['scan_path'] = os.path.dirname(path).strip()
+        job['scan_path_is_directory'] = os.path.isdir(job['check_path'])
+        return config['SERVER_FILE_CHECK_DELAY']
+
+    elif checks >= config['SERVER_MAX_FILE_CHECKS']:
+        logger.warning("File '%s' exhausted all available checks. Aborting scan request.", check_path)
+        # mark item as failed in database if sqlite is enabled
+        if config['SERVER_USE_SQLITE']:
+            if db.set_item_state(path, 'failed'):
+                logger.info("Marked '%s' as failed in Plex Autoscan database.", path)
+            else:
+                logger.error("Failed marking '%s' as failed in Plex Autoscan database.", path)
+        return None
 
-        if config['SERVER_SCAN_DELAY']:
-            logger.info("Sleeping for %d seconds...", config['SERVER_SCAN_DELAY'])
-            time.sleep(config['SERVER_SCAN_DELAY'])
+    else:
+        logger.info("File '%s' did not exist on check %d of %d. Checking again in %s seconds...", check_path,
+                    checks,
+                    config['SERVER_MAX_FILE_CHECKS'],
+                    config['SERVER_FILE_CHECK_DELAY'])
+        return config['SERVER_FILE_CHECK_DELAY']
 
-        # check if root scan folder for
-        if path in resleep_paths:
-            logger.info("Another scan request occurred for folder of '%s'.", path)
-            logger.info("Sleeping again for %d seconds...", config['SERVER_SCAN_DELAY'])
-            utils.remove_item_from_list(path, resleep_paths)
-        else:
-            break
+    # ready to wait for a scan slot
+    job['priority'] = utils.get_priority(config, job['scan_path'])
+    logger.debug("Waiting for turn in the scan request backlog with priority '%d'...", job['priority'])
+    return 0
 
-    # check file exists
-    checks = 0
-    check_path = utils.map_pushed_path_file_exists(config, path)
-    scan_path_is_directory = os.path.isdir(check_path)
 
-    while True:
-        checks += 1
-        if os.path.exists(check_path):
-            logger.info("File '%s' exists on check %d of %d.", check_path, checks, config['SERVER_MAX_FILE_CHECKS'])
-            if not scan_path or not len(scan_path):
-                scan_path = os.path.dirname(path).strip() if not scan_path_is_directory else path.strip()
-            break
-        elif not scan_path_is_directory and config['SERVER_SCAN_FOLDER_ON_FILE_EXISTS_EXHAUSTION'] and \
-                config['SERVER_MAX_FILE_CHECKS'] - checks == 1:
-            # penultimate check but SERVER_SCAN_FOLDER_ON_FILE_EXISTS_EXHAUSTION was turned on
-            # lets make scan path the folder instead for the final check
-            logger.warning(
-                "File '%s' reached the penultimate file check. Changing scan path to '%s'. Final check commences "
-                "in %s seconds...", check_path, os.path.dirname(path), config['SERVER_FILE_CHECK_DELAY'])
-            check_path = os.path.dirname(check_path).strip()
-            scan_path = os.path.dirname(path).strip()
-            scan_path_is_directory = os.path.isdir(check_path)
-            time.sleep(config['SERVER_FILE_CHECK_DELAY'])
-            # send Rclone cache clear if enabled
-            if config['RCLONE']['RC_CACHE_REFRESH']['ENABLED']:
-                utils.rclone_rc_clear_cache(config, check_path)
-
-        elif checks >= config['SERVER_MAX_FILE_CHECKS']:
-            logger.warning("File '%s' exhausted all available checks. Aborting scan request.", check_path)
-            # remove item from database if sqlite is enabled
-            if config['SERVER_USE_SQLITE']:
-                if db.remove_item(path):
-                    logger.info("Removed '%s' from Plex Autoscan database.", path)
-                    time.sleep(1)
-                else:
-                    logger.error("Failed removing '%s' from Plex Autoscan database.", path)
-            return
+def get_scanner_name(config):
+    if os.name == 'nt':
+        return os.path.basename(config['PLEX_SCANNER'])
+    return os.path.basename(config['PLEX_SCANNER']).replace('\\', '')
 
-        else:
-            logger.info("File '%s' did not exist on check %d of %d. Checking again in %s seconds...", check_path,
-                        checks,
-                        config['SERVER_MAX_FILE_CHECKS'],
-                        config['SERVER_FILE_CHECK_DELAY'])
-            time.sleep(config['SERVER_FILE_CHECK_DELAY'])
-            # send Rclone cache clear if enabled
-            if config['RCLONE']['RC_CACHE_REFRESH']['ENABLED']:
-                utils.rclone_rc_clear_cache(config, check_path)
-
-    # build plex scanner command
+
+def build_scan_command(config, section, scan_path):
     if os.name == 'nt':
         final_cmd = '"%s" --scan --refresh --section %s --directory "%s"' \
                     % (config['PLEX_SCANNER'], str(section), scan_path)
@@ -126,31 +124,30 @@ def scan(config, lock, path, scan_for, section, scan_type, resleep_paths, scan_t
             final_cmd = 'sudo -u %s bash -c %s' % (config['PLEX_USER'], cmd_quote(cmd))
         else:
             final_cmd = cmd
+    return final_cmd
 
-    # invoke plex scanner
-    priority = utils.get_priority(config, scan_path)
-    logger.debug("Waiting for turn in the scan request backlog with priority '%d'...", priority)
 
-    lock.acquire(priority)
+def run_scan(config, jobs):
+    section = jobs[0]['section']
+
+    # invoke plex scanner
     try:
-        logger.info("Scan request is now being processed...")
+        logger.info("Scan batch of %d request(s) for Section '%s' is now being processed after waiting up to %d "
+                    "seconds in the backlog...", len(jobs), section, max(job.get('wait_time', 0) for job in jobs))
         # wait for existing scanners being ran by Plex
         if config['PLEX_WAIT_FOR_EXTERNAL_SCANNERS']:
-            if os.name == 'nt':
-                scanner_name = os.path.basename(config['PLEX_SCANNER'])
-            else:
-                scanner_name = os.path.basename(config['PLEX_SCANNER']).replace('\\', '')
+            scanner_name = get_scanner_name(config)
             if not utils.wait_running_process(scanner_name, config['USE_DOCKER'], cmd_quote(config['DOCKER_NAME'])):
                 logger.warning(
                     "There was a problem waiting for existing '%s' process(s) to finish. Aborting scan.", scanner_name)
-                # remove item from database if sqlite is enabled
+                # mark items as failed in database if sqlite is enabled
                 if config['SERVER_USE_SQLITE']:
-                    if db.remove_item(path):
-                        logger.info("Removed '%s' from Plex Autoscan database.", path)
-                        time.sleep(1)
-                    else:
-                        logger.error("Failed removing '%s' from Plex Autoscan database.", path)
-                return
+                    for job in jobs:
+                        if db.set_item_state(job['path'], 'failed'):
+                            logger.info("Marked '%s' as failed in Plex Autoscan database.", job['path'])
+                        else:
+                            logger.error("Failed marking '%s' as failed in Plex Autoscan database.", job['path'])
+                return False
             else:
                 logger.info("No '%s' processes were found.", scanner_name)
 
@@ -166,59 +163,99 @@ def scan(config, lock, path, scan_for, section, scan_type, resleep_paths, scan_t
             if plex_account_user is not None:
                 logger.info("Plex is available for media scanning - (Server Account: '%s')", plex_account_user)
 
-        # begin scan
-        logger.info("Running Plex Media Scanner for: %s", scan_path)
-        logger.debug(final_cmd)
-        if os.name == 'nt':
-            utils.run_command(final_cmd)
-        else:
-            utils.run_command(final_cmd.encode("utf-8"))
-        logger.info("Finished scan!")
+        if config['SERVER_USE_SQLITE']:
+            for job in jobs:
+                db.set_item_state(job['path'], 'scanning')
+
+        # begin scan of each folder in the batch
+        scanned_paths = []
+        for job in jobs:
+            if job['scan_path'] not in scanned_paths:
+                scanned_paths.append(job['scan_path'])
+                final_cmd = build_scan_command(config, section, job['scan_path'])
+                logger.info("Running Plex Media Scanner for: %s", job['scan_path'])
+                logger.debug(final_cmd)
+                # scans of the other slots must not mistake this one for an external scanner
+                with utils.own_processes.running(get_scanner_name(config)):
+                    if os.name == 'nt':
+                        utils.run_command(final_cmd)
+                    else:
+                        utils.run_command(final_cmd.encode("utf-8"))
+                logger.info("Finished scan!")
+
+            # item moves on to post-processing in database if sqlite is enabled
+            if config['SERVER_USE_SQLITE']:
+                if db.set_item_state(job['path'], 'post_processing'):
+                    logger.debug("Marked '%s' as post-processing in Plex Autoscan database.", job['path'])
+                else:
+                    logger.error("Failed marking '%s' as post-processing in Plex Autoscan database.", job['path'])
 
-        # remove item from Plex database if sqlite is enabled
         if config['SERVER_USE_SQLITE']:
-            if db.remove_item(path):
-                logger.debug("Removed '%s' from Plex Autoscan database.", path)
-                time.sleep(1)
-                logger.info("There are %d queued item(s) remaining.", db.queued_count())
-            else:
-                logger.error("Failed removing '%s' from Plex Autoscan database.", path)
+            logger.info("There are %d queued item(s) remaining.", db.queued_count())
+        return True
+
+    except Exception:
+        logger.exception("Unexpected exception occurred while processing scan batch for Section '%s': %s", section,
+                         [job['scan_path'] for job in jobs])
+        if config['SERVER_USE_SQLITE']:
+            for job in jobs:
+                db.set_item_state(job['path'], 'failed')
+    return False
+
 
+def post_process_scan(config, jobs):
+    section = jobs[0]['section']
+
+    try:
         # empty trash if configured
         if config['PLEX_EMPTY_TRASH'] and config['PLEX_TOKEN'] and config['PLEX_EMPTY_TRASH_MAX_FILES']:
-            logger.debug("Checking deleted items count in 10 seconds...")
-            time.sleep(10)
-
             # check deleted item count, don't proceed if more than this value
-            deleted_items = get_deleted_count(config)
+            deleted_items = get_deleted_count(config, section)
             if deleted_items > config['PLEX_EMPTY_TRASH_MAX_FILES']:
-                logger.warning("There were %d deleted files. Skip emptying of trash for Section '%s'.", deleted_items,
+                logger.warning("There were %d deleted files in Section '%s'. Skip emptying of trash.", deleted_items,
                                section)
             elif deleted_items == -1:
                 logger.error("Could not determine deleted item count. Abort emptying of trash.")
-            elif not config['PLEX_EMPTY_TRASH_ZERO_DELETED'] and not deleted_items and scan_type != 'Upgrade':
+            elif not config['PLEX_EMPTY_TRASH_ZERO_DELETED'] and not deleted_items and \
+                    not any(job['scan_type'] == 'Upgrade' for job in jobs):
                 logger.debug("Skipping emptying trash as there were no deleted items.")
             else:
                 logger.info("Emptying trash to clear %d deleted items...", deleted_items)
                 empty_trash(config, str(section))
 
+        analyze_jobs = [job for job in jobs if not job['scan_path_is_directory']]
+        analyze = config['PLEX_ANALYZE_TYPE'].lower() != 'off'
+        match_jobs = [job for job in analyze_jobs if job.get('scan_title') is not None and
+                      job.get('scan_lookup_type') is not None and job.get('scan_lookup_id') is not None] \
+            if config['PLEX_FIX_MISMATCHED'] and config['PLEX_TOKEN'] else []
+        if os.path.exists(config['PLEX_DATABASE_PATH']):
+            # look up each file once, analysis and match fixing both work from the same lookup
+            for job in (analyze_jobs if analyze else match_jobs):
+                job['metadata'] = resolve_file_metadata(config, job['path'])
+            # files that could not be found in the plex db were already logged by the lookup
+            analyze_jobs = [job for job in analyze_jobs if job.get('metadata')]
+            match_jobs = [job for job in match_jobs if job.get('metadata')]
+
         # analyze movie/episode
-        if config['PLEX_ANALYZE_TYPE'].lower() != 'off' and not scan_path_is_directory:
-            logger.debug("Sleeping for 10 seconds...")
-            time.sleep(10)
-            logger.debug("Sending analysis request...")
-            analyze_item(config, path)
+        if analyze and analyze_jobs:
+            for job in analyze_jobs:
+                logger.debug("Sending analysis request for '%s'...", job['path'])
+                analyze_item(config, job['path'], job.get('metadata'))
 
         # match item
-        if config['PLEX_FIX_MISMATCHED'] and config['PLEX_TOKEN'] and not scan_path_is_directory:
+        if match_jobs:
+            if len(match_jobs) > 1:
+                # look up the parents of the whole batch at once, match_item_parent then finds them cached
+                get_metadata_parent_infos(config, [get_parent_lookup_id(job['metadata']) for job in match_jobs
+                                                   if job.get('metadata') and job['metadata']['metadata_item_id']])
+
             # were we initiated with the scan_title/scan_lookup_type/scan_lookup_id parameters?
-            if scan_title is not None and scan_lookup_type is not None and scan_lookup_id is not None:
-                logger.debug("Sleeping for 10 seconds...")
-                time.sleep(10)
+            for job in match_jobs:
                 logger.debug("Validating match for '%s' (%s ID: %s)...",
-                             scan_title,
-                             scan_lookup_type, str(scan_lookup_id))
-                match_item_parent(config, path, scan_title, scan_lookup_type, scan_lookup_id)
+                             job['scan_title'],
+                             job['scan_lookup_type'], str(job['scan_lookup_id']))
+                match_item_parent(config, job['path'], job['scan_title'], job['scan_lookup_type'],
+                                  job['scan_lookup_id'], job.get('metadata'))
 
         # run external command after scan if supplied
         if len(config['RUN_COMMAND_AFTER_SCAN']) > 2:
@@ -227,9 +264,14 @@ def scan(config, lock, path, scan_for, section, scan_type, resleep_paths, scan_t
             logger.info("Finished running external command.")
 
     except Exception:
-        logger.exception("Unexpected exception occurred while processing: '%s'", scan_path)
-    finally:
-        lock.release()
+        logger.exception("Unexpected exception occurred while post-processing scan batch for Section '%s': %s",
+                         section, [job['scan_path'] for job in jobs])
+
+    # the scan itself succeeded, so the items are done even if post-processing ran into trouble
+    if config['SERVER_USE_SQLITE']:
+        for job in jobs:
+            # a newer request for the same path may have replaced the row in the meantime, leave that one alone
+            db.set_item_state(job['path'], 'done', from_states=('post_processing',))
     return
 
 
@@ -257,19 +299,21 @@ def show_sections(config):
     os.system(final_cmd)
 
 
-def match_item_parent(config, scan_path, scan_title, scan_lookup_type, scan_lookup_id):
+def match_item_parent(config, scan_path, scan_title, scan_lookup_type, scan_lookup_id, resolved=None):
     if not os.path.exists(config['PLEX_DATABASE_PATH']):
         logger.info("Could not analyze '%s' because Plex database could not be found.", scan_path)
         return
 
-    # get files metadata_item_id
-    metadata_item_id = get_file_metadata_item_id(config, scan_path)
-    if metadata_item_id is None:
+    # get files metadata_item_id, unless the caller already looked it up
+    if resolved is None:
+        resolved = resolve_file_metadata(config, scan_path)
+    if resolved is None or not resolved['metadata_item_id']:
         logger.error("Aborting match of '%s' as could not find 'metadata_item_id'.", scan_path)
         return
+    metadata_item_id = int(resolved['metadata_item_id'])
 
     # find metadata_item_id parent info
-    metadata_item_parent_info = get_metadata_parent_info(config, int(metadata_item_id))
+    metadata_item_parent_info = get_metadata_parent_info(config, get_parent_lookup_id(resolved))
     if metadata_item_parent_info is None or 'parent_id' not in metadata_item_parent_info \
             or metadata_item_parent_info['parent_id'] is not None or 'id' not in metadata_item_parent_info \
             or 'title' not in metadata_item_parent_info:
@@ -290,7 +334,7 @@ def match_item_parent(config, scan_path, scan_title, scan_lookup_type, scan_look
     metadata_item_id_has_dupes = get_metadata_item_id_has_duplicates(config, metadata_item_id, scan_directory)
     if metadata_item_id_has_dupes:
         # there are multiple media_items with this metadata_item_id who's folder does not match the scan directory
-        # we must split the parent metadata_item, wait 10 seconds and then repeat the steps above
+        # we must split the parent metadata_item, wait for plex to write the split and then repeat the steps above
         if not split_plex_item(config, parent_metadata_item_id):
             logger.error(
                 "Aborting match of '%s' as could not split duplicate 'media_items' with 'metadata_item_id': '%d'",
@@ -303,15 +347,15 @@ def match_item_parent(config, scan_path, scan_title, scan_lookup_type, scan_look
         parent_title = None
         parent_guid = None
 
-        # sleep before looking up metadata_item_id again
-        time.sleep(10)
-        metadata_item_id = get_file_metadata_item_id(config, scan_path)
-        if metadata_item_id is None:
+        # look up metadata_item_id again once plex has moved the file, for at most the 10 seconds we used to sleep
+        resolved = resolve_file_metadata(config, scan_path, timeout=10, previous=resolved)
+        if resolved is None or not resolved['metadata_item_id']:
             logger.error("Aborting match of '%s' as could not find post split 'metadata_item_id'.", scan_path)
             return
+        metadata_item_id = int(resolved['metadata_item_id'])
 
         # now lookup parent again
-        metadata_item_parent_info = get_metadata_parent_info(config, int(metadata_item_id))
+        metadata_item_parent_info = get_metadata_parent_info(config, get_parent_lookup_id(resolved))
         if metadata_item_parent_info is None or 'parent_id' not in metadata_item_parent_info \
                 or metadata_item_parent_info['parent_id'] is not None or 'id' not in metadata_item_parent_info \
                 or 'title' not in metadata_item_parent_info:
@@ -353,12 +397,12 @@ def match_item_parent(config, scan_path, scan_title, scan_lookup_type, scan_look
     return
 
 
-def analyze_item(config, scan_path):
+def analyze_item(config, scan_path, resolved=None):
     if not os.path.exists(config['PLEX_DATABASE_PATH']):
         logger.warning("Could not analyze of '%s' because Plex database could not be found.", scan_path)
         return
     # get files metadata_item_id
-    metadata_item_ids = get_file_metadata_ids(config, scan_path)
+    metadata_item_ids = get_file_metadata_ids(config, scan_path, resolved)
     if metadata_item_ids is None or not len(metadata_item_ids):
         logger.warning("Aborting analysis of '%s' because could not find any 'metadata_item_id' for it.", scan_path)
         return
@@ -386,56 +430,79 @@ def analyze_item(config, scan_path):
     logger.debug("Starting %s analysis of 'metadata_item': %s",
                  'deep' if config['PLEX_ANALYZE_TYPE'].lower() == 'deep' else 'basic', metadata_item_id)
     logger.debug(final_cmd)
-    if os.name == 'nt':
-        utils.run_command(final_cmd)
-    else:
-        utils.run_command(final_cmd.encode("utf-8"))
+    # analysis runs plex media scanner too, a scan starting meanwhile must not wait for it as an external scanner
+    with utils.own_processes.running(get_scanner_name(config)):
+        if os.name == 'nt':
+            utils.run_command(final_cmd)
+        else:
+            utils.run_command(final_cmd.encode("utf-8"))
     logger.info("Finished %s analysis of 'metadata_item': %s",
                 'deep' if config['PLEX_ANALYZE_TYPE'].lower() == 'deep' else 'basic', metadata_item_id)
 
 
-def get_file_metadata_item_id(config, file_path):
+def wait_plex_db_write(cursor, data_version, deadline, poll_interval):
+    # returns True once another connection has committed since data_version was read, False at the deadline
+    while cursor.execute("PRAGMA data_version").fetchone()[0] == data_version:
+        if time.time() >= deadline:
+            return False
+        time.sleep(poll_interval)
+    return True
+
+
+def lookup_file_metadata(cursor, file_path):
+    row = cursor.execute('SELECT '
+                         'mp.media_item_id'
+                         ', mi.metadata_item_id'
+                         ', md.parent_id '
+                         'FROM media_parts mp '
+                         'JOIN media_items mi ON mi.id = mp.media_item_id '
+                         'JOIN metadata_items md ON md.id = mi.metadata_item_id '
+                         'WHERE mp.file = ? '
+                         'LIMIT 1', (file_path,)).fetchone()
+    return dict(row) if row else None
+
+
+def resolve_file_metadata(config, file_path, timeout=50, previous=None, poll_interval=0.25):
+    # returns the media_item_id, metadata_item_id and parent_id for file_path, waiting up to timeout seconds for plex
+    # to write them (or, when previous is given, to change them). data_version only moves when another connection
+    # commits, so the join is only run again once plex has written something
+    deadline = time.time() + timeout
     try:
-        with sqlite3.connect(config['PLEX_DATABASE_PATH']) as conn:
-            conn.row_factory = sqlite3.Row
+        # usually plex has written the rows already and a shared connection answers right away
+        with plexdb.connection(config) as conn:
             with closing(conn.cursor()) as c:
-                # query media_parts to retrieve media_item_row for this file
-                for x in range(5):
-                    media_item_row = c.execute("SELECT * FROM media_parts WHERE file=?", (file_path,)).fetchone()
-                    if media_item_row:
-                        logger.debug("Found row in 'media_parts' where 'file' = '%s' after %d of 5 tries.", file_path,
-                                     x + 1)
-                        break
-                    else:
-                        logger.error(
-                            "Could not locate record in 'media_parts' where 'file' = '%s' in %d of 5 attempts...",
-                            file_path, x + 1)
-                        time.sleep(10)
-
-                if not media_item_row:
-                    logger.error("Could not locate record in 'media_parts' where 'file' = '%s' after 5 tries.",
-                                 file_path)
-                    return None
-
-                media_item_id = media_item_row['media_item_id']
-                if media_item_id and int(media_item_id):
-                    # query db to find metadata_item_id
-                    metadata_item_id = \
-                        c.execute("SELECT * FROM media_items WHERE id=?", (int(media_item_id),)).fetchone()[
-                            'metadata_item_id']
-                    if metadata_item_id and int(metadata_item_id):
-                        logger.debug("Found 'metadata_item_id' for '%s': %d", file_path, int(metadata_item_id))
-                        return int(metadata_item_id)
+                resolved = lookup_file_metadata(c, file_path)
+        lookups = 1
+
+        if not resolved or resolved == previous:
+            with plexdb.wait_connection(config) as conn:
+                with closing(conn.cursor()) as c:
+                    while True:
+                        data_version = c.execute("PRAGMA data_version").fetchone()[0]
+                        resolved = lookup_file_metadata(c, file_path)
+                        lookups += 1
+                        if resolved and resolved != previous:
+                            break
+                        if not wait_plex_db_write(c, data_version, deadline, poll_interval):
+                            break
+
+        if resolved and resolved != previous:
+            logger.debug("Found 'metadata_item' of '%s' after %d lookups: %s", file_path, lookups, resolved)
+            return resolved
+        if resolved:
+            logger.debug("'metadata_item' of '%s' did not change within %d seconds: %s", file_path, timeout, resolved)
+            return resolved
+        logger.error("Could not locate record in 'media_parts' where 'file' = '%s' after %d seconds.", file_path,
+                     timeout)
 
     except Exception:
-        logger.exception("Exception finding 'metadata_item_id' for '%s': ", file_path)
+        logger.exception("Exception resolving 'metadata_item' for '%s': ", file_path)
     return None
 
 
 def get_metadata_item_id_has_duplicates(config, metadata_item_id, scan_directory):
     try:
-        with sqlite3.connect(config['PLEX_DATABASE_PATH']) as conn:
-            conn.row_factory = sqlite3.Row
+        with plexdb.connection(config) as conn:
             with closing(conn.cursor()) as c:
                 # retrieve matches for metadata_item_id
                 metadata_item_id_matches = c.execute('select '
@@ -462,111 +529,134 @@ def get_metadata_item_id_has_duplicates(config, metadata_item_id, scan_directory
     return False
 
 
-def get_metadata_parent_info(config, metadata_item_id):
+# {metadata_item_id: (time, root parent row)}, callers start from the season so its episodes share one entry. entries
+# expire so edits made through plex itself are picked up
+parent_info_cache = utils.LRUCache(4096)
+PARENT_INFO_MAX_AGE = 300
+
+
+def get_parent_lookup_id(resolved):
+    # episodes start the walk to the show from their season, items without a parent (movies) are the root themselves
+    return int(resolved['parent_id']) if resolved['parent_id'] else int(resolved['metadata_item_id'])
+
+
+def get_metadata_parent_infos(config, metadata_item_ids):
+    # returns {metadata_item_id: parent row} for the root parent (no parent_id) of each metadata_item_id
+    results = {}
+    missing = []
+    now = time.time()
+    for metadata_item_id in set(int(x) for x in metadata_item_ids):
+        cached = parent_info_cache.get(metadata_item_id)
+        if cached is not None and now - cached[0] < PARENT_INFO_MAX_AGE:
+            results[metadata_item_id] = dict(cached[1])
+        else:
+            missing.append(metadata_item_id)
+    if not missing:
+        return results
+
     try:
-        with sqlite3.connect(config['PLEX_DATABASE_PATH']) as conn:
-            conn.row_factory = sqlite3.Row
+        with plexdb.connection(config) as conn:
             with closing(conn.cursor()) as c:
-                # retrieve parent info for metadata_item_id
-                metadata_item_parent_info = c.execute('WITH cte_MediaItems AS ('
-                                                      'SELECT '
-                                                      'mi.* '
-                                                      'FROM metadata_items mi '
-                                                      'WHERE mi.id = ? '
-                                                      'UNION '
-                                                      'SELECT mi.* '
-                                                      'FROM cte_MediaItems cte '
-                                                      'JOIN metadata_items mi ON mi.id = cte.parent_id'
-                                                      ') '
-                                                      'SELECT '
-                                                      'cte.id'
-                                                      ', cte.parent_id'
-                                                      ', cte.guid'
-                                                      ', cte.title '
-                                                      'FROM cte_MediaItems cte '
-                                                      'WHERE cte.parent_id IS NULL '
-                                                      'LIMIT 1', (metadata_item_id,)).fetchone()
-                if metadata_item_parent_info:
-                    metadata_item_row = dict(metadata_item_parent_info)
-                    if 'parent_id' in metadata_item_row and not metadata_item_row['parent_id']:
-                        logger.debug("Found parent row in 'metadata_items' for 'metadata_item_id' '%d': %s",
-                                     int(metadata_item_id), metadata_item_row)
-                        return metadata_item_row
-
-                logger.error("Failed finding parent row in 'metadata_items' for 'metadata_item_id': %d",
-                             int(metadata_item_id))
+                # walk up from every metadata_item_id at once, remembering where each walk started
+                for row in c.execute('WITH cte_MediaItems AS ('
+                                     'SELECT '
+                                     'mi.id AS origin_id'
+                                     ', mi.id'
+                                     ', mi.parent_id'
+                                     ', mi.guid'
+                                     ', mi.title '
+                                     'FROM metadata_items mi '
+                                     'WHERE mi.id IN (%s) '
+                                     'UNION '
+                                     'SELECT cte.origin_id'
+                                     ', mi.id'
+                                     ', mi.parent_id'
+                                     ', mi.guid'
+                                     ', mi.title '
+                                     'FROM cte_MediaItems cte '
+                                     'JOIN metadata_items mi ON mi.id = cte.parent_id'
+                                     ') '
+                                     'SELECT '
+                                     'cte.origin_id'
+                                     ', cte.id'
+                                     ', cte.parent_id'
+                                     ', cte.guid'
+                                     ', cte.title '
+                                     'FROM cte_MediaItems cte '
+                                     'WHERE cte.parent_id IS NULL' % ','.join('?' * len(missing)), missing):
+                    metadata_item_row = dict(row)
+                    origin_id = metadata_item_row.pop('origin_id')
+                    if origin_id in results:
+                        continue
+                    results[origin_id] = metadata_item_row
+                    parent_info_cache.put(origin_id, (now, dict(metadata_item_row)))
 
     except Exception:
-        logger.exception("Exception finding parent info for 'metadata_item_id' '%d': ", int(metadata_item_id))
+        logger.exception("Exception finding parent info for 'metadata_item_ids' %s: ", missing)
+    return results
+
+
+def get_metadata_parent_info(config, metadata_item_id):
+    metadata_item_row = get_metadata_parent_infos(config, [metadata_item_id]).get(int(metadata_item_id))
+    if metadata_item_row:
+        logger.debug("Found parent row in 'metadata_items' for 'metadata_item_id' '%d': %s",
+                     int(metadata_item_id), metadata_item_row)
+        return metadata_item_row
+
+    logger.error("Failed finding parent row in 'metadata_items' for 'metadata_item_id': %d", int(metadata_item_id))
     return None
 
 
-def get_file_metadata_ids(config, file_path):
+def invalidate_metadata_parent_info(metadata_item_id):
+    # forget every cached parent lookup that started at or ended in metadata_item_id
+    metadata_item_id = int(metadata_item_id)
+    parent_info_cache.discard(lambda key, value: key == metadata_item_id or value[1]['id'] == metadata_item_id)
+
+
+def get_file_metadata_ids(config, file_path, resolved=None):
     results = []
-    media_item_row = None
+
+    if resolved is None:
+        resolved = resolve_file_metadata(config, file_path)
+    if not resolved:
+        return None
 
     try:
-        with sqlite3.connect(config['PLEX_DATABASE_PATH']) as conn:
-            conn.row_factory = sqlite3.Row
-            with closing(conn.cursor()) as c:
-                # query media_parts to retrieve media_item_row for this file
-                for x in range(5):
-                    media_item_row = c.execute("SELECT * FROM media_parts WHERE file=?", (file_path,)).fetchone()
-                    if media_item_row:
-                        logger.debug("Found row in 'media_parts' where 'file' = '%s' after %d of 5 tries.", file_path,
-                                     x + 1)
-                        break
-                    else:
-                        logger.error(
-                            "Could not locate record in 'media_parts' where 'file' = '%s' in %d of 5 attempts...",
-                            file_path, x + 1)
-                        time.sleep(10)
-
-                if not media_item_row:
-                    logger.error("Could not locate record in 'media_parts' where 'file' = '%s' after 5 tries",
-                                 file_path)
-                    return None
-
-                media_item_id = media_item_row['media_item_id']
-                if media_item_id and int(media_item_id):
-                    # query db to find metadata_item_id
-                    metadata_item_id = \
-                        c.execute("SELECT * FROM media_items WHERE id=?", (int(media_item_id),)).fetchone()[
-                            'metadata_item_id']
-                    if metadata_item_id and int(metadata_item_id):
-                        logger.debug("Found 'metadata_item_id' for '%s': %d", file_path, int(metadata_item_id))
-
-                        # query db to find parent_id of metadata_item_id
-                        if config['PLEX_ANALYZE_DIRECTORY']:
-                            parent_id = \
-                                c.execute("SELECT * FROM metadata_items WHERE id=?",
-                                          (int(metadata_item_id),)).fetchone()['parent_id']
-                            if not parent_id or not int(parent_id):
-                                # could not find parent_id of this item, likely its a movie...
-                                # lets just return the metadata_item_id
-                                return [int(metadata_item_id)]
-                            logger.debug("Found 'parent_id' for '%s': %d", file_path, int(parent_id))
-
-                            # if mode is basic, single parent_id is enough
-                            if config['PLEX_ANALYZE_TYPE'].lower() == 'basic':
-                                return [int(parent_id)]
-
-                            # lets find all metadata_item_id's with this parent_id for use with deep analysis
-                            metadata_items = c.execute("SELECT * FROM metadata_items WHERE parent_id=?",
-                                                       (int(parent_id),)).fetchall()
-                            if not metadata_items:
-                                # could not find any results, lets just return metadata_item_id
-                                return [int(metadata_item_id)]
-
-                            for row in metadata_items:
-                                if row['id'] and int(row['id']) and int(row['id']) not in results:
-                                    results.append(int(row['id']))
-
-                            logger.debug("Found 'media_item_id' for '%s': %s", file_path, results)
-                            logger.info("Found %d 'media_item_id' to deep analyze for: '%s'", len(results), file_path)
-                        else:
-                            # user had PLEX_ANALYZE_DIRECTORY as False - lets just scan the single metadata_item_id
-                            results.append(int(metadata_item_id))
+        metadata_item_id = resolved['metadata_item_id']
+        if metadata_item_id and int(metadata_item_id):
+            logger.debug("Found 'metadata_item_id' for '%s': %d", file_path, int(metadata_item_id))
+
+            # parent_id of metadata_item_id came with the same lookup
+            if config['PLEX_ANALYZE_DIRECTORY']:
+                parent_id = resolved['parent_id']
+                if not parent_id or not int(parent_id):
+                    # could not find parent_id of this item, likely its a movie...
+                    # lets just return the metadata_item_id
+                    return [int(metadata_item_id)]
+                logger.debug("Found 'parent_id' for '%s': %d", file_path, int(parent_id))
+
+                # if mode is basic, single parent_id is enough
+                if config['PLEX_ANALYZE_TYPE'].lower() == 'basic':
+                    return [int(parent_id)]
+
+                # lets find all metadata_item_id's with this parent_id for use with deep analysis
+                with plexdb.connection(config) as conn:
+                    with closing(conn.cursor()) as c:
+                        metadata_items = c.execute("SELECT id FROM metadata_items WHERE parent_id=?",
+                                                   (int(parent_id),)).fetchall()
+                if not metadata_items:
+                    # could not find any results, lets just return metadata_item_id
+                    return [int(metadata_item_id)]
+
+                for row in metadata_items:
+                    if row['id'] and int(row['id']) and int(row['id']) not in results:
+                        results.append(int(row['id']))
+
+                logger.debug("Found 'media_item_id' for '%s': %s", file_path, results)
+                logger.info("Found %d 'media_item_id' to deep analyze for: '%s'", len(results), file_path)
+            else:
+                # user had PLEX_ANALYZE_DIRECTORY as False - lets just scan the single metadata_item_id
+                results.append(int(metadata_item_id))
 
     except Exception as ex:
         logger.exception("Exception finding metadata_item_id for '%s': ", file_path)
@@ -633,24 +723,32 @@ def wait_plex_alive(config):
     return None
 
 
-def get_deleted_count(config):
+def get_deleted_count(config, section):
+    # counted for every batch after its own scan, a count from before a scan can miss files that went missing during it
     try:
-        with sqlite3.connect(config['PLEX_DATABASE_PATH']) as conn:
+        with plexdb.connection(config) as conn:
             with closing(conn.cursor()) as c:
                 deleted_metadata = \
-                    c.execute('SELECT count(*) FROM metadata_items WHERE deleted_at IS NOT NULL').fetchone()[0]
+                    c.execute('SELECT count(*) FROM metadata_items '
+                              'WHERE library_section_id = ? AND deleted_at IS NOT NULL', (int(section),)).fetchone()[0]
                 deleted_media_parts = \
-                    c.execute('SELECT count(*) FROM media_parts WHERE deleted_at IS NOT NULL').fetchone()[0]
+                    c.execute('SELECT count(*) FROM media_parts mp '
+                              'JOIN media_items mi ON mi.id = mp.media_item_id '
+                              'WHERE mi.library_section_id = ? AND mp.deleted_at IS NOT NULL',
+                              (int(section),)).fetchone()[0]
 
         return int(deleted_metadata) + int(deleted_media_parts)
 
     except Exception as ex:
-        logger.exception("Exception retrieving deleted item count from Plex DB: ")
+        logger.exception("Exception retrieving deleted item count for Section '%s' from Plex DB: ", section)
     return -1
 
 
 def split_plex_item(config, metadata_item_id):
     try:
+        # cached parent lookups through this item are stale once plex changes it
+        invalidate_metadata_parent_info(metadata_item_id)
+
         url_params = {
             'X-Plex-Token': config['PLEX_TOKEN']
         }
@@ -673,6 +771,9 @@ def split_plex_item(config, metadata_item_id):
 
 def match_plex_item(config, metadata_item_id, new_guid, new_name):
     try:
+        # cached parent lookups through this item are stale once plex changes it
+        invalidate_metadata_parent_info(metadata_item_id)
+
         url_params = {
             'X-Plex-Token': config['PLEX_TOKEN'],
             'guid': new_guid,
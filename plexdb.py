@@ -0,0 +1,176 @@
+import hashlib
+import logging
+import math
+import os
+import sqlite3
+import struct
+import threading
+from contextlib import contextmanager
+
+try:
+    from urllib import pathname2url
+except ImportError:
+    from urllib.request import pathname2url
+
+logger = logging.getLogger("PLEXDB")
+
+
+def connect(database_path, timeout=30, cached_statements=128):
+    # read-only, so we never contend with plex media server for the write lock
+    try:
+        conn = sqlite3.connect('file:%s?mode=ro' % pathname2url(os.path.abspath(database_path)), uri=True,
+                               timeout=timeout, check_same_thread=False, cached_statements=cached_statements)
+    except TypeError:
+        # python without sqlite uri support
+        conn = sqlite3.connect(database_path, timeout=timeout, check_same_thread=False,
+                               cached_statements=cached_statements)
+    conn.row_factory = sqlite3.Row
+    conn.isolation_level = None
+    conn.execute("PRAGMA query_only = 1")
+    conn.execute("PRAGMA busy_timeout = %d" % int(timeout * 1000))
+    return conn
+
+
+class ConnectionPool:
+    def __init__(self, database_path, size=5, timeout=30):
+        self.database_path = database_path
+        self.size = size
+        self.timeout = timeout
+        self._idle = []
+        self._lock = threading.Lock()
+        self._available = threading.Semaphore(size)
+
+    @contextmanager
+    def connection(self):
+        self._available.acquire()
+        conn = None
+        try:
+            with self._lock:
+                if self._idle:
+                    conn = self._idle.pop()
+            if conn is None:
+                logger.debug("Opening read-only connection to the Plex DB located at '%s'", self.database_path)
+                conn = connect(self.database_path, timeout=self.timeout)
+            yield conn
+        except sqlite3.Error:
+            # do not hand a possibly broken connection to the next caller
+            if conn is not None:
+                conn.close()
+                conn = None
+            raise
+        finally:
+            if conn is not None:
+                with self._lock:
+                    self._idle.append(conn)
+            self._available.release()
+
+    def close(self):
+        with self._lock:
+            for conn in self._idle:
+                conn.close()
+            self._idle = []
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(database_path, size=5, name='queries'):
+    with _pools_lock:
+        pool = _pools.get((database_path, name))
+        if pool is None:
+            pool = _pools[(database_path, name)] = ConnectionPool(database_path, size=size)
+        return pool
+
+
+def pool_size(config):
+    # every post-processing worker, the google drive monitor and the parts index refresh can query at the same time
+    return config['SERVER_POST_PROCESS_WORKERS'] + 2
+
+
+def connection(config):
+    return get_pool(config['PLEX_DATABASE_PATH'], pool_size(config)).connection()
+
+
+def wait_connection(config):
+    # waiting for plex to write can take a while, those connections come from their own pool so they never hold up
+    # the quick queries above
+    return get_pool(config['PLEX_DATABASE_PATH'], config['SERVER_POST_PROCESS_WORKERS'], name='waits').connection()
+
+
+class BloomFilter:
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = capacity
+        self.bits = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, int(round(self.bits / float(capacity) * math.log(2))))
+        self.count = 0
+        self._bitmap = bytearray((self.bits + 7) // 8)
+
+    def _positions(self, key):
+        # double hashing, k positions from two 64 bit halves of one digest
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(key.encode('utf-8')).digest())
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self._bitmap[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self._bitmap[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class PartsIndex:
+    def __init__(self, pool, capacity, refresh_interval=60, batch_size=10000):
+        self.pool = pool
+        self.refresh_interval = refresh_interval
+        self.batch_size = batch_size
+        self.ready = False
+        self._filter = BloomFilter(capacity)
+        self._last_id = 0
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        # media_parts ids only grow, so only rows newer than the last one seen are read
+        with self._lock:
+            added = 0
+            while True:
+                with self.pool.connection() as conn:
+                    rows = conn.execute("SELECT id, file FROM media_parts WHERE id > ? ORDER BY id LIMIT ?",
+                                        (self._last_id, self.batch_size)).fetchall()
+                if not rows:
+                    break
+                for part_id, file_path in rows:
+                    if file_path:
+                        self._filter.add(file_path)
+                self._last_id = rows[-1][0]
+                added += len(rows)
+
+            if added and self._filter.count > self._filter.capacity:
+                logger.warning("Plex media parts index holds %d parts, more than its capacity of %d, "
+                               "expect more lookups in the Plex DB.", self._filter.count, self._filter.capacity)
+            if not self.ready:
+                logger.info("Built Plex media parts index with %d parts.", added)
+            self.ready = True
+        return added
+
+    def candidates(self, file_paths):
+        # returns the paths that may be in media_parts, false positives are possible, misses are not. new parts are
+        # picked up by the periodic refresh, the caller never waits on one
+        if not self.ready:
+            return list(file_paths)
+        return [file_path for file_path in file_paths if file_path in self._filter]
+
+
+_parts_indexes = {}
+
+
+def get_parts_index(config):
+    if not config['PLEX_PARTS_INDEX']:
+        return None
+    pool = get_pool(config['PLEX_DATABASE_PATH'], pool_size(config))
+    with _pools_lock:
+        index = _parts_indexes.get(config['PLEX_DATABASE_PATH'])
+        if index is None:
+            index = _parts_indexes[config['PLEX_DATABASE_PATH']] = PartsIndex(pool, config['PLEX_PARTS_INDEX_CAPACITY'])
+        return index
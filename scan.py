@@ -39,7 +39,6 @@ logging.getLogger('requests').setLevel(logging.ERROR)
 logging.getLogger('werkzeug').setLevel(logging.ERROR)
 logging.getLogger('peewee').setLevel(logging.ERROR)
 logging.getLogger('urllib3.connectionpool').setLevel(logging.ERROR)
-logging.getLogger('sqlitedict').setLevel(logging.ERROR)
 
 # Console logger, log to stdout instead of stderr
 consoleHandler = logging.StreamHandler(sys.stdout)
@@ -69,12 +68,22 @@ logger = rootLogger.getChild("AUTOSCAN")
 
 # Multiprocessing
 thread = threads.Thread()
-scan_lock = threads.PriorityLock()
-resleep_paths = []
+scan_scheduler = threads.ScanScheduler(conf.configs['SERVER_SCAN_SLOTS'], conf.configs['SERVER_SCAN_SECTION_SLOTS'],
+                                       conf.configs['SERVER_SCAN_PRIORITY_AGING'], conf.configs['SERVER_SCAN_MAX_WAIT'],
+                                       conf.configs['SERVER_SCAN_SOURCE_WEIGHTS'],
+                                       conf.configs['SERVER_SCAN_BATCH_SIZE'])
+timers = threads.TimerHeap(name='timers')
+scan_debouncer = threads.DebounceScheduler(timers)
+scan_pool = threads.WorkerPool(conf.configs['SERVER_SCAN_WORKERS'], name='scan_worker')
+# plex media scanner runs get a worker per scan slot of their own, so long scans never hold up the file checks
+scanner_pool = threads.WorkerPool(max([scan_scheduler.slots] + list(scan_scheduler.section_slots.values())),
+                                  name='scanner')
+post_process_pool = threads.WorkerPool(conf.configs['SERVER_POST_PROCESS_WORKERS'], name='post_process_worker')
 
 # local imports
 import db
 import plex
+import plexdb
 import utils
 import rclone
 import google
@@ -82,6 +91,9 @@ import google
 google_drive = None
 manager = None
 
+# interrupted scans restored from the database are retried this many times
+MAX_SCAN_ATTEMPTS = 3
+
 
 ############################################################
 # QUEUE PROCESSOR
@@ -89,24 +101,49 @@ manager = None
 
 
 def queue_processor():
-    logger.info("Starting queue processor in 10 seconds...")
     try:
-        time.sleep(10)
         logger.info("Queue processor started.")
         db_scan_requests = db.get_all_items()
         items = 0
         for db_item in db_scan_requests:
-            thread.start(plex.scan, args=[conf.configs, scan_lock, db_item['scan_path'], db_item['scan_for'],
-                                          db_item['scan_section'],
-                                          db_item['scan_type'], resleep_paths])
+            job = {'path': db_item['scan_path'], 'scan_for': db_item['scan_for'],
+                   'section': db_item['scan_section'], 'scan_type': db_item['scan_type']}
+
+            if db_item['state'] == 'scanning' and db_item['attempts'] >= MAX_SCAN_ATTEMPTS:
+                # do not keep retrying a scan that was interrupted every time it ran
+                logger.warning("Scan of '%s' was interrupted %d times. Giving up on it.", job['path'],
+                               db_item['attempts'])
+                db.set_item_state(job['path'], 'failed')
+                continue
+
+            if db_item['state'] == 'post_processing':
+                # the scan itself finished before the restart, only post-processing is left
+                check_path = utils.map_pushed_path_file_exists(conf.configs, job['path'])
+                job['scan_path_is_directory'] = os.path.isdir(check_path)
+                job['scan_path'] = job['path'] if job['scan_path_is_directory'] else os.path.dirname(job['path'])
+                logger.info("Resuming post-processing of '%s'.", job['path'])
+                post_process_pool.submit(plex.post_process_scan, [conf.configs, [job]])
+                items += 1
+                continue
+
+            if not scan_debouncer.push(db_item['scan_dir'], job, conf.configs['SERVER_SCAN_DELAY']):
+                # scanned together with the restored requests from the same folder
+                logger.info("Restored scan request for '%s' joins the others from the same folder.", job['path'])
             items += 1
-            time.sleep(2)
         logger.info("Restored %d scan request(s) from Plex Autoscan database.", items)
     except Exception:
         logger.exception("Exception while processing scan requests from Plex Autoscan database.")
     return
 
 
+def queue_purger():
+    purged = db.purge_finished_items()
+    if purged:
+        logger.info("Purged %d finished item(s) from Plex Autoscan database.", purged)
+    timers.schedule(3600, scan_pool.submit, args=[queue_purger], name="queue purger")
+    return
+
+
 ############################################################
 # FUNCS
 ############################################################
@@ -119,30 +156,112 @@ def start_scan(path, scan_for, scan_type, scan_title=None, scan_lookup_type=None
     else:
         logger.info("Using Section ID '%d' for '%s'", section, path)
 
+    # folder names may contain dots as well, so whether this is a folder request is checked on disk
+    scan_dir = utils.get_scan_directory_key(path, os.path.isdir(utils.map_pushed_path_file_exists(conf.configs, path)))
+
     if conf.configs['SERVER_USE_SQLITE']:
-        db_exists, db_file = db.exists_file_root_path(path)
-        if not db_exists and db.add_item(path, scan_for, section, scan_type):
+        db_exists, db_file = db.exists_file_root_path(scan_dir)
+        if not db_exists and db.add_item(path, scan_for, section, scan_type, scan_dir):
             logger.info("Added '%s' to Plex Autoscan database.", path)
             logger.info("Proceeding with scan...")
         else:
             logger.info(
                 "Already processing '%s' from same folder. Skip adding extra scan request to the queue.", db_file)
-            resleep_paths.append(db_file)
+            if db_file and scan_debouncer.touch(db.get_scan_dir(db_file), conf.configs['SERVER_SCAN_DELAY']):
+                logger.info("Delaying scan of '%s' for another %d seconds...", db_file,
+                            conf.configs['SERVER_SCAN_DELAY'])
             return False
 
-    thread.start(plex.scan,
-                 args=[conf.configs, scan_lock, path, scan_for, section, scan_type, resleep_paths, scan_title,
-                       scan_lookup_type, scan_lookup_id])
+    job = {'path': path, 'scan_for': scan_for, 'section': section, 'scan_type': scan_type, 'scan_title': scan_title,
+           'scan_lookup_type': scan_lookup_type, 'scan_lookup_id': scan_lookup_id}
+    if not scan_debouncer.push(scan_dir, job, conf.configs['SERVER_SCAN_DELAY']):
+        # the request keeps its own match details and scan type, it is released together with the others
+        logger.info("Another scan request occurred for folder of '%s'. Delaying scan for another %d seconds...", path,
+                    conf.configs['SERVER_SCAN_DELAY'])
+        return True
+
+    logger.info("Scan request from %s for '%s' will start in %d seconds...", scan_for, path,
+                conf.configs['SERVER_SCAN_DELAY'])
+    return True
+
+
+def release_scan(jobs):
+    scan_pool.submit(check_scan, args=[jobs])
+    return
+
+
+def check_scan(jobs):
+    # requests released together enter the scan backlog together, so they end up in the same scan batch
+    ready = []
+    waiting = {}
+    for job in jobs:
+        delay = plex.scan(conf.configs, job)
+        if delay == 0:
+            ready.append(job)
+        elif delay is not None:
+            waiting.setdefault(delay, []).append(job)
+    if ready:
+        scan_scheduler.submit_all(ready)
+    for delay, waiting_jobs in waiting.items():
+        # files did not exist yet, wait on a timer instead of holding the worker
+        timers.schedule(delay, scan_pool.submit, args=[check_scan, [waiting_jobs]],
+                        name="file check: %s" % ', '.join(job['path'] for job in waiting_jobs))
+    return
+
+
+def run_scan(jobs):
+    # the scan slot is released once this returns, post-processing continues on its own workers
+    if plex.run_scan(conf.configs, jobs):
+        # metadata lookups wait for plex to write the rows themselves, so there is no need to hold off here
+        logger.debug("Post-processing scan batch...")
+        post_process_pool.submit(plex.post_process_scan, [conf.configs, jobs])
+    return
+
+
+def start_scan_debouncer():
+    scan_debouncer.start(release_scan)
+    return True
+
+
+def start_scan_workers():
+    timers.start()
+    scan_pool.start()
+    scanner_pool.start()
+    post_process_pool.start()
+    scan_scheduler.start(run_scan, scanner_pool)
     return True
 
 
 def start_queue_reloader():
-    thread.start(queue_processor)
+    logger.info("Starting queue processor in 10 seconds...")
+    timers.schedule(10, scan_pool.submit, args=[queue_processor], name="queue processor")
+    timers.schedule(3600, scan_pool.submit, args=[queue_purger], name="queue purger")
+    return True
+
+
+def start_parts_index():
+    parts_index = plexdb.get_parts_index(conf.configs)
+    if not parts_index:
+        return False
+    logger.info("Building Plex media parts index in the background...")
+    thread.start(refresh_parts_index, name="parts index", args=[parts_index])
     return True
 
 
+def refresh_parts_index(parts_index):
+    try:
+        parts_index.refresh()
+    except Exception:
+        logger.exception("Exception %s Plex media parts index, trying again in %d seconds: ",
+                         "refreshing" if parts_index.ready else "building", parts_index.refresh_interval)
+    timers.schedule(parts_index.refresh_interval, scan_pool.submit, args=[refresh_parts_index, [parts_index]],
+                    name="parts index refresh")
+    return
+
+
 def start_google_monitor():
-    thread.start(thread_google_monitor)
+    logger.info("Starting Google Drive monitoring in 30 seconds...")
+    timers.schedule(30, thread.start, args=[thread_google_monitor], name="google drive monitor")
     return True
 
 
@@ -187,9 +306,6 @@ def process_google_changes(items_added):
 def thread_google_monitor():
     global manager
 
-    logger.info("Starting Google Drive monitoring in 30 seconds...")
-    time.sleep(30)
-
     # initialize crypt_decoder to None
     crypt_decoder = None
 
@@ -266,6 +382,26 @@ def api_call():
                 return jsonify({'error': 'SERVER_USE_SQLITE must be enabled'})
             return jsonify({'queue_count': db.get_queue_count()})
 
+        elif cmd == 'queue_stats':
+            # queue items, ages and latency by job state
+            if not conf.configs['SERVER_USE_SQLITE']:
+                # return error if SQLITE db is not enabled
+                return jsonify({'error': 'SERVER_USE_SQLITE must be enabled'})
+            return jsonify({'queue_stats': db.get_state_stats()})
+
+        elif cmd == 'stats':
+            # scan backlog stats
+            return jsonify({'scan_workers': scan_pool.stats(),
+                            'scanner_workers': scanner_pool.stats(),
+                            'post_process_workers': post_process_pool.stats(),
+                            'scan_slots': scan_scheduler.stats(),
+                            'debounce_pending': scan_debouncer.pending(),
+                            'timers_pending': len(timers.pending())})
+
+        elif cmd == 'timers':
+            # every pending timer, soonest first
+            return jsonify({'timers': timers.pending()})
+
         else:
             # unknown cmd
             return jsonify({'error': 'Unknown cmd: %s' % cmd})
@@ -526,10 +662,14 @@ if __name__ == "__main__":
             sys.exit(0)
 
     elif conf.args['cmd'] == 'server':
+        start_scan_workers()
+        start_scan_debouncer()
+
         if conf.configs['SERVER_USE_SQLITE']:
             start_queue_reloader()
 
         if conf.configs['GOOGLE']['ENABLED']:
+            start_parts_index()
             start_google_monitor()
 
         logger.info("Starting server: http://%s:%d/%s",
@@ -1,21 +1,24 @@
 #!/usr/bin/env python
+import random
 import time
 
-from threads import Thread, PriorityLock
+from threads import ScanScheduler, WorkerPool
 
 
 ############################################################
 # MISC
 ############################################################
 
-def test_thread(lock, priority):
-    lock.acquire(priority)
-    try:
-        print("Hello from priority: %s" % str(priority))
-        time.sleep(5)
-    finally:
-        lock.release()
-    print("Finished priority: %s" % str(priority))
+def test_job(jobs):
+    print("Hello from section: %d, priorities: %s" % (jobs[0]['section'], [job['priority'] for job in jobs]))
+    time.sleep(random.randint(1, 5))
+    print("Finished section: %d, batch of %d" % (jobs[0]['section'], len(jobs)))
+
+
+def submit_batch(scheduler):
+    for pos in reversed(range(0, 100)):
+        scheduler.submit({'section': pos % 3 + 1, 'priority': pos, 'scan_path': '/test/%d' % pos,
+                          'scan_for': 'Sonarr' if pos % 2 else 'Google Drive'})
 
 
 ############################################################
@@ -23,14 +26,15 @@ def test_thread(lock, priority):
 ############################################################
 
 if __name__ == "__main__":
-    lock = PriorityLock()
-    threads = Thread()
-    for pos in reversed(range(0, 100)):
-        threads.start(test_thread, args=[lock, pos], track=True)
-    print("Started first batch of threads")
+    pool = WorkerPool(4)
+    scheduler = ScanScheduler(2, {3: 1}, aging=5, source_weights={'Sonarr': 4, 'Google Drive': 1}, batch_size=10)
+    pool.start()
+    scheduler.start(test_job, pool)
+    submit_batch(scheduler)
+    print("Started first batch of jobs")
     time.sleep(15)
-    for pos in reversed(range(0, 100)):
-        threads.start(test_thread, args=[lock, pos], track=True)
-    print("Started second batch of threads")
-    threads.join()
-    print("All threads finished")
+    submit_batch(scheduler)
+    print("Started second batch of jobs")
+    while scheduler.stats()['waiting'] or scheduler.stats()['running']:
+        time.sleep(1)
+    print("All jobs finished")
@@ -4,41 +4,375 @@ try:
 except ImportError:
     # Fallback to the Python 2 Queue module
     import Queue as queue
-import datetime
+import collections
 import copy
+import heapq
+import logging
 import threading
+import time
 
+logger = logging.getLogger("THREADS")
 
-class PriorityLock:
-    def __init__(self):
-        self._is_available = True
+
+class ScanScheduler:
+    def __init__(self, slots=1, section_slots=None, aging=0, max_wait=0, source_weights=None, batch_size=0):
+        self.slots = max(1, int(slots))
+        self.section_slots = {}
+        for section, section_limit in (section_slots if section_slots else {}).items():
+            self.section_slots[int(section)] = max(1, int(section_limit))
+        # seconds of waiting that improve a waiters priority by one level, 0 disables aging
+        self.aging = max(0, aging)
+        # seconds after which a waiter is promoted to the front of the backlog, 0 disables the deadline
+        self.max_wait = max(0, max_wait)
+        # relative share of the backlog given to each request source (scan_for), unknown sources get 1
+        self.source_weights = {}
+        for source, weight in (source_weights if source_weights else {}).items():
+            self.source_weights[source] = max(0.01, float(weight))
+        # maximum number of same folder requests drained into one scan batch, 0 drains all of them
+        self.batch_size = max(0, int(batch_size))
+        self._virtual_time = 0.0
+        self._source_finish = {}
+        self._flows = {}
         self._mutex = threading.Lock()
-        self._waiter_queue = queue.PriorityQueue()
-
-    def acquire(self, priority=0):
-        self._mutex.acquire()
-        # First, just check the lock.
-        if self._is_available:
-            self._is_available = False
-            self._mutex.release()
-            return True
-        event = threading.Event()
-        self._waiter_queue.put((priority, datetime.datetime.now(), event))
-        self._mutex.release()
-        event.wait()
-        # When the event is triggered, we have the lock.
+        self._waiters = []
+        self._running = {}
+        self._added = 0
+        self._wait_times = collections.deque(maxlen=1000)
+        self._target = None
+        self._pool = None
+
+    def start(self, target, pool):
+        self._target = target
+        self._pool = pool
+        self._dispatch()
+        return True
+
+    def submit(self, job):
+        return self.submit_all([job])
+
+    def submit_all(self, jobs):
+        # jobs submitted together wait as one group, so a free slot drains all of them into the same batch
+        with self._mutex:
+            for job in jobs:
+                self._added += 1
+                job['queued_seq'] = self._added
+                job['queued_at'] = time.time()
+                # start-time fair queuing, each source advances its own virtual clock by 1 / weight per request
+                source = job.get('scan_for')
+                job['virtual_start'] = max(self._virtual_time, self._source_finish.get(source, 0.0))
+                self._source_finish[source] = job['virtual_start'] + 1.0 / self.source_weights.get(source, 1.0)
+                flow = self._flows.setdefault(source, [])
+                if not flow:
+                    job['head_since'] = job['queued_at']
+                flow.append(job)
+                self._waiters.append(job)
+        self._dispatch()
+        return True
+
+    def stats(self):
+        now = time.time()
+        with self._mutex:
+            backlog = [{'path': job['scan_path'], 'section': job['section'], 'source': job.get('scan_for'),
+                        'priority': job['priority'],
+                        'effective_priority': self._effective_priority(job, now),
+                        'wait': round(now - job['queued_at'], 1)}
+                       for job in sorted(self._waiters, key=lambda item: self._waiter_key(item, now))]
+            wait_times = sorted(self._wait_times)
+            running = dict((str(section), [job['scan_path'] for job in batch])
+                           for section, batch in self._running.items())
+
+        sources = {}
+        for item in backlog:
+            sources[item['source']] = sources.get(item['source'], 0) + 1
+
+        return {'slots': self.slots, 'section_slots': self.section_slots, 'waiting': len(backlog),
+                'waiting_by_source': sources, 'running': running, 'backlog': backlog,
+                'wait_times': {
+                    'count': len(wait_times),
+                    'p50': round(wait_times[int(len(wait_times) * 0.50)], 1) if wait_times else 0,
+                    'p95': round(wait_times[int(len(wait_times) * 0.95)], 1) if wait_times else 0,
+                    'max': round(wait_times[-1], 1) if wait_times else 0,
+                    'oldest_waiting': max([item['wait'] for item in backlog]) if backlog else 0
+                }}
+
+    def _effective_priority(self, job, now):
+        # only the oldest request of each source ages, so a large backlog from one source cannot out-age the others
+        if not self.aging or 'head_since' not in job:
+            return job['priority']
+        return job['priority'] - int((now - job['head_since']) // self.aging)
+
+    def _waiter_key(self, job, now):
+        if self.max_wait and now - job['queued_at'] >= self.max_wait:
+            # deadline expired, promote to the front in order of arrival
+            return 0, 0, 0.0, job['queued_seq']
+        return 1, self._effective_priority(job, now), job['virtual_start'], job['queued_seq']
+
+    def _remove_waiter(self, job, now):
+        self._waiters.remove(job)
+        flow = self._flows[job.get('scan_for')]
+        was_head = flow[0] is job
+        flow.remove(job)
+        if was_head and flow:
+            flow[0]['head_since'] = now
+        self._virtual_time = max(self._virtual_time, job['virtual_start'])
+
+    def _section_limit(self, section):
+        return self.section_slots.get(section, self.slots)
+
+    def _has_free_slot(self, section):
+        # respect the slot limit of the section being started and of every running section
+        running = len(self._running)
+        if running >= self._section_limit(section):
+            return False
+        for running_section in self._running:
+            if running >= self._section_limit(running_section):
+                return False
         return True
 
-    def release(self):
-        self._mutex.acquire()
-        # Notify the next thread in line, if any.
+    def _dispatch(self):
+        if self._pool is None:
+            return
+        started = []
+        now = time.time()
+        with self._mutex:
+            waiters = sorted(self._waiters, key=lambda item: self._waiter_key(item, now))
+            for job in waiters:
+                if job['section'] in self._running:
+                    # never run two scans of the same section at once
+                    continue
+                if not self._has_free_slot(job['section']):
+                    # keep the slot for this waiter instead of letting lower priorities jump ahead
+                    break
+                # drain the waiting requests for the same folder into the batch, they need a single scanner run.
+                # other folders wait their own turn, so a big batch cannot hold the slot past higher ranked waiters
+                batch = [item for item in waiters if item['section'] == job['section'] and
+                         item['scan_path'] == job['scan_path']]
+                if self.batch_size:
+                    batch = batch[:self.batch_size]
+                for item in batch:
+                    self._remove_waiter(item, now)
+                    item['wait_time'] = now - item['queued_at']
+                    self._wait_times.append(item['wait_time'])
+                self._running[job['section']] = batch
+                started.append(batch)
+        for batch in started:
+            logger.debug("Starting scan batch of %d request(s) for section %d after waiting up to %.1f seconds in the "
+                         "backlog.", len(batch), batch[0]['section'], max(item['wait_time'] for item in batch))
+            self._pool.submit(self._run, args=[batch])
+
+    def _run(self, batch):
         try:
-            _, timeAdded, event = self._waiter_queue.get_nowait()
-        except queue.Empty:
-            self._is_available = True
-        else:
-            event.set()
-        self._mutex.release()
+            self._target(batch)
+        finally:
+            with self._mutex:
+                self._running.pop(batch[0]['section'], None)
+            self._dispatch()
+
+
+class TimerHeap:
+    def __init__(self, name=None):
+        self._name = name
+        self._timers = {}
+        self._deadlines = []
+        self._added = 0
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=self._name)
+        self._thread.daemon = True
+        self._thread.start()
+        return self._thread
+
+    def schedule(self, delay, target, args=None, name=None):
+        # target is called from the timer thread, so it should only hand work off (e.g. WorkerPool.submit)
+        with self._cond:
+            self._added += 1
+            deadline = time.time() + max(0, delay)
+            self._timers[self._added] = {'deadline': deadline, 'armed': deadline, 'target': target,
+                                         'args': args if args else [], 'name': name if name else repr(target)}
+            heapq.heappush(self._deadlines, (deadline, self._added))
+            self._cond.notify()
+            return self._added
+
+    def reschedule(self, timer_id, delay):
+        with self._cond:
+            timer = self._timers.get(timer_id)
+            if timer is None:
+                return False
+            timer['deadline'] = time.time() + max(0, delay)
+            if timer['deadline'] < timer['armed']:
+                # an earlier deadline needs a new heap entry, the old one becomes stale
+                timer['armed'] = timer['deadline']
+                heapq.heappush(self._deadlines, (timer['deadline'], timer_id))
+                self._cond.notify()
+        return True
+
+    def cancel(self, timer_id):
+        with self._cond:
+            return self._timers.pop(timer_id, None) is not None
+
+    def pending(self):
+        now = time.time()
+        with self._cond:
+            timers = sorted(self._timers.values(), key=lambda item: item['deadline'])
+            return [{'name': timer['name'], 'due_in': round(timer['deadline'] - now, 1)} for timer in timers]
+
+    def _next_timer(self):
+        with self._cond:
+            while True:
+                now = time.time()
+                if not self._deadlines:
+                    self._cond.wait()
+                    continue
+                deadline, timer_id = self._deadlines[0]
+                if deadline > now:
+                    self._cond.wait(deadline - now)
+                    continue
+
+                heapq.heappop(self._deadlines)
+                timer = self._timers.get(timer_id)
+                if timer is None or timer['armed'] != deadline:
+                    # cancelled, or superseded by an earlier heap entry
+                    continue
+                if timer['deadline'] > now:
+                    # deadline was pushed back while waiting, re-arm with the new deadline
+                    timer['armed'] = timer['deadline']
+                    heapq.heappush(self._deadlines, (timer['deadline'], timer_id))
+                    continue
+                del self._timers[timer_id]
+                return timer
+
+    def _run(self):
+        while True:
+            timer = self._next_timer()
+            try:
+                timer['target'](*timer['args'])
+            except Exception:
+                logger.exception("Exception running timer: %s", timer['name'])
+
+
+class DebounceScheduler:
+    def __init__(self, timers):
+        self._timers = timers
+        self._callback = None
+        self._jobs = {}
+        self._mutex = threading.Lock()
+
+    def start(self, callback):
+        self._callback = callback
+        return True
+
+    def push(self, key, job, delay):
+        # returns True when a new job was scheduled, False when job joined the jobs already waiting for key
+        with self._mutex:
+            if key in self._jobs and self._timers.reschedule(self._jobs[key][0], delay):
+                self._jobs[key][1].append(job)
+                return False
+            jobs = [job]
+            timer_id = self._timers.schedule(delay, self._release, args=[key, jobs], name="debounce: %s" % key)
+            self._jobs[key] = [timer_id, jobs]
+        return True
+
+    def touch(self, key, delay):
+        with self._mutex:
+            if key not in self._jobs:
+                return False
+            return self._timers.reschedule(self._jobs[key][0], delay)
+
+    def pending(self):
+        with self._mutex:
+            return sum(len(jobs) for timer_id, jobs in self._jobs.values())
+
+    def _release(self, key, jobs):
+        # every job pushed for key while it was waiting is released together
+        with self._mutex:
+            if key in self._jobs and self._jobs[key][1] is jobs:
+                del self._jobs[key]
+        self._callback(jobs)
+
+
+class WorkerPool:
+    def __init__(self, size, name=None):
+        self.size = max(1, int(size))
+        self._name = name if name else 'worker'
+        self._queue = queue.Queue()
+        self._active = 0
+        self._mutex = threading.Lock()
+        self._workers = []
+
+    def start(self):
+        for pos in range(self.size - len(self._workers)):
+            worker = threading.Thread(target=self._run, name='%s_%d' % (self._name, len(self._workers) + 1))
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+        return True
+
+    def submit(self, target, args=None):
+        self._queue.put((target, args if args else []))
+        return True
+
+    def stats(self):
+        with self._mutex:
+            active = self._active
+        return {'size': self.size, 'active': active, 'queued': self._queue.qsize()}
+
+    def _run(self):
+        while True:
+            target, args = self._queue.get()
+            with self._mutex:
+                self._active += 1
+            try:
+                target(*args)
+            except Exception:
+                logger.exception("Exception in worker running %r: ", target)
+            finally:
+                with self._mutex:
+                    self._active -= 1
+                self._queue.task_done()
+
+
+class GroupCommitter:
+    def __init__(self, commit, max_batch=500, name=None):
+        # commit(items) writes items in a single transaction and returns one result per item
+        self.commit = commit
+        self.max_batch = max_batch
+        self.name = name
+        self._queue = queue.Queue()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=self.name)
+        self._thread.daemon = True
+        self._thread.start()
+        return self._thread
+
+    def submit(self, item):
+        # blocks until the batch holding item has been committed, then returns its result
+        entry = {'item': item, 'result': None, 'done': threading.Event()}
+        self._queue.put(entry)
+        entry['done'].wait()
+        return entry['result']
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            # take whatever queued up while the last commit ran, a lone caller is committed right away
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                results = self.commit([entry['item'] for entry in batch])
+            except Exception:
+                logger.exception("Exception committing batch of %d item(s): ", len(batch))
+                results = [None] * len(batch)
+            for entry, result in zip(batch, results):
+                entry['result'] = result
+                entry['done'].set()
 
 
 class Thread:
@@ -1,11 +1,12 @@
 import json
 import logging
 import os
-import sqlite3
 import subprocess
 import sys
+import threading
 import time
-from contextlib import closing
+from collections import OrderedDict
+from contextlib import closing, contextmanager
 from copy import copy
 
 import requests
@@ -17,24 +18,21 @@ except ImportError:
 
 import psutil
 
+import plexdb
+
 logger = logging.getLogger("UTILS")
 
 
 def get_plex_section(config, path):
     try:
-        with sqlite3.connect(config['PLEX_DATABASE_PATH']) as conn:
-            conn.row_factory = sqlite3.Row
-            conn.text_factory = str
-            with closing(conn.cursor()) as c:
-                # check if file exists in plex
-                logger.debug("Checking if root folder path '%s' matches Plex Library root path in the Plex DB.", path)
-                section_data = c.execute("SELECT library_section_id,root_path FROM section_locations").fetchall()
-                for section_id, root_path in section_data:
-                    if path.startswith(root_path + os.sep):
-                        logger.debug("Plex Library Section ID '%d' matching root folder '%s' was found in the Plex DB.",
-                                     section_id, root_path)
-                        return int(section_id)
-                logger.error("Unable to map '%s' to a Section ID.", path)
+        logger.debug("Checking if root folder path '%s' matches Plex Library root path in the Plex DB.", path)
+        match = get_section_index(config['PLEX_DATABASE_PATH']).lookup(path)
+        if match:
+            root_path, section_id = match
+            logger.debug("Plex Library Section ID '%d' matching root folder '%s' was found in the Plex DB.",
+                         section_id, root_path[:-len(os.sep)])
+            return section_id
+        logger.error("Unable to map '%s' to a Section ID.", path)
 
     except Exception:
         logger.exception("Exception while trying to map '%s' to a Section ID in the Plex DB: ", path)
@@ -55,79 +53,257 @@ def ensure_valid_os_path_sep(path):
     return path
 
 
+class LRUCache:
+    def __init__(self, size=4096):
+        self.size = size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._items:
+                return default
+            value = self._items.pop(key)
+            self._items[key] = value
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            if len(self._items) > self.size:
+                self._items.popitem(last=False)
+        return value
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._items.pop(key, default)
+
+    def discard(self, predicate):
+        # removes every entry for which predicate(key, value) is true
+        with self._lock:
+            for key, value in list(self._items.items()):
+                if predicate(key, value):
+                    del self._items[key]
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+class PrefixTrie:
+    def __init__(self):
+        self._root = {}
+        self._end = object()
+
+    def insert(self, prefix, value):
+        node = self._root
+        for char in prefix:
+            node = node.setdefault(char, {})
+        # first definition of a prefix wins
+        node.setdefault(self._end, (prefix, value))
+
+    def longest_prefix(self, path):
+        node = self._root
+        match = node.get(self._end)
+        for char in path:
+            node = node.get(char)
+            if node is None:
+                break
+            match = node.get(self._end, match)
+        return match
+
+
+class PathMapper:
+    def __init__(self, mappings, cache_size=4096):
+        self.mappings = mappings
+        self._trie = PrefixTrie()
+        self._cache = LRUCache(cache_size)
+        for mapped_path, prefixes in mappings.items():
+            for prefix in prefixes:
+                self._trie.insert(prefix, mapped_path)
+
+    def match(self, path):
+        # returns (prefix, mapped_path) of the longest matching prefix, or None
+        match = self._cache.get(path, False)
+        if match is False:
+            match = self._cache.put(path, self._trie.longest_prefix(path))
+        return match
+
+
+_path_mappers = {}
+
+
+def get_path_mapper(name, mappings):
+    # mappings are compiled once per loaded config
+    mapper = _path_mappers.get(name)
+    if mapper is None or mapper.mappings is not mappings:
+        mapper = PathMapper(mappings)
+        _path_mappers[name] = mapper
+    return mapper
+
+
+class SectionIndex:
+    def __init__(self, database_path, check_interval=60):
+        self.database_path = database_path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._conn = None
+        self._data_version = None
+        self._checked_at = 0
+        self._trie = None
+
+    def _refresh(self, force=False):
+        # only asks the plex db whether anything changed every check_interval seconds, or when forced
+        if not force and self._trie is not None and time.time() - self._checked_at < self.check_interval:
+            return
+        if self._conn is None:
+            # data_version is only comparable on the same connection, so the index keeps its own
+            self._conn = plexdb.connect(self.database_path)
+        data_version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+        self._checked_at = time.time()
+        if self._trie is not None and data_version == self._data_version:
+            return
+
+        trie = PrefixTrie()
+        count = 0
+        for section_id, root_path in self._conn.execute("SELECT library_section_id,root_path FROM section_locations"):
+            trie.insert(root_path + os.sep, int(section_id))
+            count += 1
+        self._trie = trie
+        self._data_version = data_version
+        logger.debug("Loaded %d Plex Library section locations from the Plex DB.", count)
+
+    def lookup(self, path):
+        # returns (root_path, section_id) of the longest matching section location, or None
+        with self._lock:
+            try:
+                self._refresh()
+                match = self._trie.longest_prefix(path)
+                if match is None:
+                    # a section may have been added since the last check
+                    self._refresh(force=True)
+                    match = self._trie.longest_prefix(path)
+                return match
+            except Exception:
+                if self._conn is not None:
+                    self._conn.close()
+                self._conn = None
+                self._trie = None
+                raise
+
+
+_section_indexes = {}
+
+
+def get_section_index(database_path):
+    index = _section_indexes.get(database_path)
+    if index is None:
+        index = _section_indexes.setdefault(database_path, SectionIndex(database_path))
+    return index
+
+
 def map_pushed_path(config, path):
-    for mapped_path, mappings in config['SERVER_PATH_MAPPINGS'].items():
-        for mapping in mappings:
-            if path.startswith(mapping):
-                logger.debug("Mapping server path '%s' to '%s'.", mapping, mapped_path)
-                return ensure_valid_os_path_sep(path.replace(mapping, mapped_path))
+    match = get_path_mapper('SERVER_PATH_MAPPINGS', config['SERVER_PATH_MAPPINGS']).match(path)
+    if match:
+        mapping, mapped_path = match
+        logger.debug("Mapping server path '%s' to '%s'.", mapping, mapped_path)
+        return ensure_valid_os_path_sep(mapped_path + path[len(mapping):])
     return path
 
 
 def map_pushed_path_file_exists(config, path):
-    for mapped_path, mappings in config['SERVER_FILE_EXIST_PATH_MAPPINGS'].items():
-        for mapping in mappings:
-            if path.startswith(mapping):
-                logger.debug("Mapping file check path '%s' to '%s'.", mapping, mapped_path)
-                return ensure_valid_os_path_sep(path.replace(mapping, mapped_path))
+    match = get_path_mapper('SERVER_FILE_EXIST_PATH_MAPPINGS', config['SERVER_FILE_EXIST_PATH_MAPPINGS']).match(path)
+    if match:
+        mapping, mapped_path = match
+        logger.debug("Mapping file check path '%s' to '%s'.", mapping, mapped_path)
+        return ensure_valid_os_path_sep(mapped_path + path[len(mapping):])
     return path
 
 
 # For Rclone dir cache clear request
 def map_file_exists_path_for_rclone(config, path):
-    for mapped_path, mappings in config['RCLONE']['RC_CACHE_REFRESH']['FILE_EXISTS_TO_REMOTE_MAPPINGS'].items():
-        for mapping in mappings:
-            if path.startswith(mapping):
-                logger.debug("Mapping Rclone file check path '%s' to '%s'.", mapping, mapped_path)
-                return path.replace(mapping, mapped_path)
+    match = get_path_mapper('FILE_EXISTS_TO_REMOTE_MAPPINGS',
+                            config['RCLONE']['RC_CACHE_REFRESH']['FILE_EXISTS_TO_REMOTE_MAPPINGS']).match(path)
+    if match:
+        mapping, mapped_path = match
+        logger.debug("Mapping Rclone file check path '%s' to '%s'.", mapping, mapped_path)
+        return mapped_path + path[len(mapping):]
     return path
 
 
-def is_process_running(process_name, plex_container=None):
+class OwnProcesses:
+    # counts the commands this app is running right now per process name, so waits for other processes skip them
+    def __init__(self):
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def running(self, process_name):
+        with self._lock:
+            self._counts[process_name.lower()] = self._counts.get(process_name.lower(), 0) + 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._counts[process_name.lower()] -= 1
+
+    def count(self, process_name):
+        with self._lock:
+            return self._counts.get(process_name.lower(), 0)
+
+
+own_processes = OwnProcesses()
+
+
+def get_running_processes(process_name, plex_container=None):
+    # returns (process, container) of every running process named process_name
+    processes = []
     try:
         for process in psutil.process_iter():
-            if process.name().lower() == process_name.lower():
-                if not plex_container:
-                    return True, process, plex_container
-                # plex_container was not None
-                # we need to check if this processes is from the container we are interested in
-                get_pid_container = "docker inspect --format '{{.Name}}' \"$(cat /proc/%s/cgroup |head -n 1 " \
-                                    "|cut -d / -f 3)\" | sed 's/^\///'" % process.pid
-                process_container = run_command(get_pid_container, True)
-                logger.debug("Using: %s", get_pid_container)
-                logger.debug("Docker Container For PID %s: %r", process.pid,
-                             process_container.strip() if process_container is not None else 'Unknown???')
-                if process_container is not None and isinstance(process_container, str) and \
-                        process_container.strip().lower() == plex_container.lower():
-                    return True, process, process_container.strip()
-
-        return False, None, plex_container
-    except psutil.ZombieProcess:
-        return False, None, plex_container
+            try:
+                if process.name().lower() != process_name.lower():
+                    continue
+            except psutil.ZombieProcess:
+                continue
+            if not plex_container:
+                processes.append((process, plex_container))
+                continue
+            # plex_container was not None
+            # we need to check if this processes is from the container we are interested in
+            get_pid_container = "docker inspect --format '{{.Name}}' \"$(cat /proc/%s/cgroup |head -n 1 " \
+                                "|cut -d / -f 3)\" | sed 's/^\///'" % process.pid
+            process_container = run_command(get_pid_container, True)
+            logger.debug("Using: %s", get_pid_container)
+            logger.debug("Docker Container For PID %s: %r", process.pid,
+                         process_container.strip() if process_container is not None else 'Unknown???')
+            if process_container is not None and isinstance(process_container, str) and \
+                    process_container.strip().lower() == plex_container.lower():
+                processes.append((process, process_container.strip()))
     except Exception:
         logger.exception("Exception checking for process: '%s': ", process_name)
-        return False, None, plex_container
+    return processes
 
 
 def wait_running_process(process_name, use_docker=False, plex_container=None):
+    # processes started by this app (scans of other slots, analysis) are not external, only the rest is waited for
     try:
-        running, process, container = is_process_running(process_name,
-                                                         None if not use_docker or not plex_container else
-                                                         plex_container)
-        while running and process:
-            logger.info("'%s' is running, pid: %d,%s cmdline: %r. Checking again in 60 seconds...", process.name(),
-                        process.pid,
+        while True:
+            processes = get_running_processes(process_name,
+                                              None if not use_docker or not plex_container else plex_container)
+            own = own_processes.count(process_name)
+            if len(processes) <= own:
+                return True
+
+            process, container = processes[-1]
+            logger.info("'%s' is running, pid: %d,%s cmdline: %r, %d of %d running are our own. Checking again in 60 "
+                        "seconds...", process.name(), process.pid,
                         ' container: %s,' % container.strip() if use_docker and isinstance(container, str) else '',
-                        process.cmdline())
+                        process.cmdline(), own, len(processes))
             time.sleep(60)
-            running, process, container = is_process_running(process_name,
-                                                             None if not use_docker or not plex_container else
-                                                             plex_container)
-
-        return True
 
     except Exception:
-        logger.exception("Exception waiting for process: '%s'", process_name())
+        logger.exception("Exception waiting for process: '%s'", process_name)
 
         return False
 
@@ -151,27 +327,108 @@ def run_command(command, get_output=False):
     return rc if not get_output else total_output
 
 
+class AhoCorasick:
+    def __init__(self, patterns):
+        # patterns is a list of (pattern, value) tuples
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [[]]
+        for pattern, value in patterns:
+            state = 0
+            for char in pattern:
+                if char not in self._goto[state]:
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append([])
+                    self._goto[state][char] = len(self._goto) - 1
+                state = self._goto[state][char]
+            self._output[state].append(value)
+
+        # breadth first construction of failure links
+        queue = list(self._goto[0].values())
+        while queue:
+            state = queue.pop(0)
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail_state = self._fail[state]
+                while fail_state and char not in self._goto[fail_state]:
+                    fail_state = self._fail[fail_state]
+                fail_target = self._goto[fail_state].get(char, 0)
+                self._fail[next_state] = fail_target if fail_target != next_state else 0
+                self._output[next_state] = self._output[next_state] + self._output[self._fail[next_state]]
+
+    def search(self, text):
+        # returns the values of every pattern found in text
+        found = list(self._output[0])
+        state = 0
+        for char in text:
+            while state and char not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(char, 0)
+            found.extend(self._output[state])
+        return found
+
+
+class PathRules:
+    def __init__(self, ignore_list, scan_priorities, cache_size=4096):
+        self.ignore_list = ignore_list
+        self.scan_priorities = scan_priorities
+        self._cache = LRUCache(cache_size)
+        patterns = []
+        for order, item in enumerate(ignore_list):
+            patterns.append((item.lower(), ('ignore', (order,), item)))
+        for group_order, (priority, paths) in enumerate(scan_priorities.items()):
+            for order, path in enumerate(paths):
+                patterns.append((path.lower(), ('priority', (group_order, order), int(priority))))
+        self._matcher = AhoCorasick(patterns)
+
+    def match(self, path):
+        # returns (matched ignore item or None, matched priority or None), earliest configured entry wins
+        result = self._cache.get(path)
+        if result is None:
+            best = {}
+            for kind, order, value in self._matcher.search(path.lower()):
+                if kind not in best or order < best[kind][0]:
+                    best[kind] = (order, value)
+            result = self._cache.put(path, (best['ignore'][1] if 'ignore' in best else None,
+                                            best['priority'][1] if 'priority' in best else None))
+        return result
+
+
+_path_rules = None
+
+
+def match_path_rules(config, path):
+    # ignore list and scan priorities are compiled once per loaded config
+    global _path_rules
+    rules = _path_rules
+    if rules is None or rules.ignore_list is not config['SERVER_IGNORE_LIST'] or \
+            rules.scan_priorities is not config['SERVER_SCAN_PRIORITIES']:
+        rules = PathRules(config['SERVER_IGNORE_LIST'], config['SERVER_SCAN_PRIORITIES'])
+        _path_rules = rules
+    return rules.match(path)
+
+
 def should_ignore(file_path, config):
-    for item in config['SERVER_IGNORE_LIST']:
-        if item.lower() in file_path.lower():
-            return True, item
+    ignore_match, _ = match_path_rules(config, file_path)
+    if ignore_match is not None:
+        return True, ignore_match
 
     return False, None
 
 
-def remove_item_from_list(item, from_list):
-    while item in from_list:
-        from_list.pop(from_list.index(item))
-    return
+def get_scan_directory_key(path, is_directory):
+    # requests for files in the same folder share a key, folder requests use the folder itself
+    scan_dir = path if is_directory else os.path.dirname(path)
+    return os.path.normpath(scan_dir).lower()
 
 
 def get_priority(config, scan_path):
     try:
-        for priority, paths in config['SERVER_SCAN_PRIORITIES'].items():
-            for path in paths:
-                if path.lower() in scan_path.lower():
-                    logger.debug("Using priority '%d' for path '%s'", int(priority), scan_path)
-                    return int(priority)
+        _, priority = match_path_rules(config, scan_path)
+        if priority is not None:
+            logger.debug("Using priority '%d' for path '%s'", priority, scan_path)
+            return priority
         logger.debug("Using default priority '0' for path '%s'", scan_path)
     except Exception:
         logger.exception("Exception determining priority to use for '%s': ", scan_path)
@@ -260,50 +517,70 @@ def dump_json(file_path, obj, processing=True):
     return
 
 
+def get_plex_file_sizes(config, plex_file_paths, chunk_size=500):
+    # exact matches can use the media_parts file index, a leading wildcard LIKE scans the whole table
+    sizes = {}
+    plex_file_paths = list(set(plex_file_paths))
+    with plexdb.connection(config) as conn:
+        with closing(conn.cursor()) as c:
+            for start in range(0, len(plex_file_paths), chunk_size):
+                chunk = plex_file_paths[start:start + chunk_size]
+                for file_path, size in c.execute("SELECT file, size FROM media_parts WHERE file IN (%s)" %
+                                                 ','.join('?' * len(chunk)), chunk):
+                    sizes.setdefault(file_path, size)
+    return sizes
+
+
 def remove_files_exist_in_plex_database(config, file_paths):
     removed_items = 0
     plex_db_path = config['PLEX_DATABASE_PATH']
     try:
         if plex_db_path and os.path.exists(plex_db_path):
-            with sqlite3.connect(plex_db_path) as conn:
-                conn.row_factory = sqlite3.Row
-                with closing(conn.cursor()) as c:
-                    for file_path in copy(file_paths):
-                        # check if file exists in plex
-                        file_name = os.path.basename(file_path)
-                        file_path_plex = map_pushed_path(config, file_path)
-                        logger.debug("Checking to see if '%s' exists in the Plex DB located at '%s'", file_path_plex,
-                                     plex_db_path)
-                        found_item = c.execute("SELECT size FROM media_parts WHERE file LIKE ?",
-                                               ('%' + file_path_plex,)) \
-                            .fetchone()
-                        file_path_actual = map_pushed_path_file_exists(config, file_path_plex)
-                        # should plex file size and file size on disk be checked?
-                        disk_file_size_check = True
-
-                        if 'DISABLE_DISK_FILE_SIZE_CHECK' in config['GOOGLE'] \
-                                and config['GOOGLE']['DISABLE_DISK_FILE_SIZE_CHECK']:
-                            disk_file_size_check = False
-
-                        if found_item:
-                            logger.debug("'%s' was found in the Plex DB media_parts table.", file_name)
-                            skip_file = False
-                            if not disk_file_size_check:
-                                skip_file = True
-                            elif os.path.isfile(file_path_actual):
-                                # check if file sizes match in plex
-                                file_size = os.path.getsize(file_path_actual)
-                                logger.debug(
-                                    "Checking to see if the file size of '%s' matches the existing file size of '%s' in the Plex DB.",
-                                    file_size, found_item[0])
-                                if file_size == found_item[0]:
-                                    logger.debug("'%s' size matches size found in the Plex DB.", file_size)
-                                    skip_file = True
-
-                            if skip_file:
-                                logger.debug("Removing path from scan queue: '%s'", file_path)
-                                file_paths.remove(file_path)
-                                removed_items += 1
+            plex_file_paths = dict((file_path, map_pushed_path(config, file_path)) for file_path in file_paths)
+            logger.debug("Checking to see if %d file(s) exist in the Plex DB located at '%s'", len(plex_file_paths),
+                         plex_db_path)
+            parts_index = plexdb.get_parts_index(config)
+            if parts_index:
+                # only paths the index may know about need confirming in the Plex DB
+                plex_file_sizes = get_plex_file_sizes(config, parts_index.candidates(plex_file_paths.values()))
+            else:
+                plex_file_sizes = get_plex_file_sizes(config, plex_file_paths.values())
+
+            # should plex file size and file size on disk be checked?
+            disk_file_size_check = True
+
+            if 'DISABLE_DISK_FILE_SIZE_CHECK' in config['GOOGLE'] \
+                    and config['GOOGLE']['DISABLE_DISK_FILE_SIZE_CHECK']:
+                disk_file_size_check = False
+
+            for file_path in copy(file_paths):
+                # check if file exists in plex
+                file_name = os.path.basename(file_path)
+                file_path_plex = plex_file_paths[file_path]
+                if file_path_plex not in plex_file_sizes:
+                    continue
+
+                logger.debug("'%s' was found in the Plex DB media_parts table.", file_name)
+                plex_file_size = plex_file_sizes[file_path_plex]
+                skip_file = False
+                if not disk_file_size_check:
+                    skip_file = True
+                else:
+                    file_path_actual = map_pushed_path_file_exists(config, file_path_plex)
+                    if os.path.isfile(file_path_actual):
+                        # check if file sizes match in plex
+                        file_size = os.path.getsize(file_path_actual)
+                        logger.debug(
+                            "Checking to see if the file size of '%s' matches the existing file size of '%s' in the Plex DB.",
+                            file_size, plex_file_size)
+                        if file_size == plex_file_size:
+                            logger.debug("'%s' size matches size found in the Plex DB.", file_size)
+                            skip_file = True
+
+                if skip_file:
+                    logger.debug("Removing path from scan queue: '%s'", file_path)
+                    file_paths.remove(file_path)
+                    removed_items += 1
 
     except Exception:
         logger.exception("Exception checking if %s exists in the Plex DB: ", file_paths)